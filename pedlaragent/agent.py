@@ -1,8 +1,11 @@
 
 import argparse
+import glob
 from collections import namedtuple
 from datetime import datetime
+import inspect
 import logging
+import os
 import re
 import struct
 import time
@@ -11,11 +14,16 @@ import json
 import pandas as pd
 import numpy as np
 
-import requests
-
 # Datafeed functions 
 from . import iex
+from . import truefx
 from . import portcalc
+from . import tickbus
+from .pricehistory import PriceHistory, Fields
+from .bars import BarStore
+from . import records
+from .replay import TickReplay
+from .uploader import Uploader
 
 logger = logging.getLogger(__name__)
 
@@ -32,8 +40,13 @@ class Agent:
     
 
     def __init__(self, maxsteps=20, universe=None, ondatafunc=None, ondataparams=None,
-    username="algosoc", agentname='random', pedlarurl='https://pedlardev.herokuapp.com/'):
+    username="algosoc", agentname='random', pedlarurl='https://pedlardev.herokuapp.com/', truefxid='', truefxpassword='',
+    barsizes=('1s', '1min', '5min'), recordformat=None, recordpath='PedlarRecords', asyncclient=False):
         
+        # poll IEX with the aiohttp TOPSClient instead of requests
+        self.asyncclient = asyncclient
+        self.truefxid = truefxid
+        self.truefxpassword = truefxpassword
 
         self.maxlookup = 1000
         self.tradesession = 0
@@ -42,8 +55,17 @@ class Agent:
         self.agentname = agentname
         self.maxsteps = maxsteps
         
-        self.history = pd.DataFrame(columns=Tick).set_index(['time', 'exchange', 'ticker'])
-        self.orderbook = pd.DataFrame(columns=Book).set_index(['exchange', 'ticker'])
+        self.pricehistory = PriceHistory(self.maxlookup)
+        self.bars = BarStore(barsizes, self.maxlookup)
+        # checkpoints are appended as parquet files when pyarrow is installed
+        if recordformat is None:
+            recordformat = 'csv' if records.pa is None else 'parquet'
+        self.recordformat = recordformat
+        self.recordpath = recordpath
+        self._lastticks = pd.DataFrame(columns=Tick)
+        self.replay = None
+        self.iexclient = None
+        self.truefxstream = None
         
         # List of holding history to be merge at the end of trading session 
         self.holdingshistory = []
@@ -63,6 +85,34 @@ class Agent:
         self.ondata = ondatafunc
         self.ondatauserparms = ondataparams
 
+    @property
+    def history(self):
+        """Price history as a (time, exchange, ticker) indexed DataFrame."""
+        return self.pricehistory.frame()
+
+    @property
+    def lastticks(self):
+        """Ticks of the last update, replayed ticks are only framed when read."""
+        if self._lastticks is None:
+            self._lastticks = self.replay.last_tick()
+        return self._lastticks
+
+    @lastticks.setter
+    def lastticks(self, ticks):
+        self._lastticks = ticks
+
+    @property
+    def orderbook(self):
+        """Most recent ticks as an (exchange, ticker) indexed DataFrame."""
+        orderbook = self.lastticks.set_index(['exchange', 'ticker'])[Book[2:]]
+        orderbook['mid'] = (orderbook['ask'] + orderbook['bid'])/2
+        return orderbook
+
+    @property
+    def portfolio(self):
+        """Current holdings as a DataFrame with a volume column."""
+        return pd.DataFrame({'volume': self.rebalancer.positions.copy()}, index=self.portfolioindex)
+
     @classmethod
     def from_args(cls, parents=None):
         """Create agent instance from command line arguments."""
@@ -71,15 +121,18 @@ class Agent:
                                                                          parents=parents or list())
         parser.add_argument("-u", "--username", default="nobody", help="Pedlar Web username.")
         parser.add_argument("-s", "--pedlarurl", default="", help="Algosoc Server")
+        parser.add_argument("-f", "--truefxid", default="", help="Username for Truefx")
+        parser.add_argument("-p", "--truefxpassword", default="", help="Truefx password.")
         return cls(**vars(parser.parse_args()))
 
 
     def start_agent(self, verbose=True):
         # create user profile in MongoDB if not exist 
         if self.connection:
+            # portfolio snapshots are uploaded in batches by a background thread
+            self.uploader = Uploader(self.endpoint)
             payload = {'user':self.username,'agent':self.agentname}
-            r = requests.post(self.endpoint+"/user", json=payload)
-            data = r.json()
+            data = self.uploader.post("/user", payload)
             self.tradesession = data['tradesession']
             if verbose:
                 print('Tradesession: {}'.format(self.tradesession))
@@ -88,22 +141,47 @@ class Agent:
         # connect to other datasource 
         # set up trading universe
         self.step = 0
+        self.stats = portcalc.PnLStats()
         self.create_portfolio(self.universe,verbose)
+        # only build the history DataFrame for strategies that ask for it
+        params = inspect.signature(self.ondata).parameters
+        varkw = any(p.kind == p.VAR_KEYWORD for p in params.values())
+        self.ondatahistory = varkw or 'history' in params
+        self.ondatapricehistory = varkw or 'pricehistory' in params
+        self.ondatabars = varkw or 'bars' in params
         return None
 
+    def ondata_history(self):
+        """History keyword arguments requested by the ondata signature."""
+        kwargs = {}
+        if self.ondatahistory:
+            kwargs['history'] = self.history
+        if self.ondatapricehistory:
+            kwargs['pricehistory'] = self.pricehistory
+        if self.ondatabars:
+            kwargs['bars'] = self.bars
+        return kwargs
+
 
     def create_portfolio(self, tickerlist=None, verbose=False):
 
         if tickerlist is None:
             tickerlist = [('IEX','SPY'), ('IEX','QQQ')]
 
-        self.portfolio = pd.DataFrame(columns=['volume'], index=pd.MultiIndex.from_tuples(tickerlist, names=('exchange', 'ticker'))) 
-        self.portfolio['volume'] = 0
+        # positions and quotes are float64 arrays aligned with the asset index
+        self.portfolioindex = pd.MultiIndex.from_tuples(tickerlist, names=('exchange', 'ticker'))
+        self.assetindex = dict((asset, i) for i, asset in enumerate(tickerlist))
+        self.assetnames = [exchange + ticker for exchange, ticker in tickerlist]
+        self.rebalancer = portcalc.Rebalancer(len(tickerlist))
+        self.bid = np.full(len(tickerlist), np.nan)
+        self.ask = np.full(len(tickerlist), np.nan)
+        self.mid = np.full(len(tickerlist), np.nan)
 
         iextickers = [x[1] for x in tickerlist if x[0]=='IEX']
         self.iextickernames = ','.join(iextickers)
         if self.iextickernames == '':
             self.iextickernames = 'SPY,QQQ'
+        self.truefxtickers = [x[1] for x in tickerlist if x[0]=='TrueFX']
 
         if verbose:
             print('Portfolio')
@@ -115,33 +193,60 @@ class Agent:
         return None 
 
     def download_tick(self):
-        iexdata = iex.get_TOPS(self.iextickernames)
+        # reuse pooled connections of the aiohttp client when asked for
+        if self.asyncclient:
+            if self.iexclient is None:
+                self.iexclient = iex.TOPSClient(self.iextickernames.split(','))
+            iexdata = self.iexclient.get_TOPS()
+        else:
+            iexdata = iex.get_TOPS(self.iextickernames)
+        if self.truefxtickers:
+            # only the FX pairs whose quote changed, the order book keeps the rest
+            if self.truefxstream is None:
+                self.truefxstream = truefx.TrueFXStream(self.truefxtickers, self.truefxid, self.truefxpassword)
+            truefxdata = self.truefxstream.read()
+            return pd.concat([truefxdata, iexdata], axis=0, ignore_index=True)
         return iexdata
 
     def extract_tick(self):
-        iexdata = pd.DataFrame()
+        iexdata = self.replay.next_tick()
         return iexdata 
 
-    def update_history(self, live=True, verbose=False):
+    def clock(self):
+        """Wall clock in live runs, time of the replayed ticks in backtests."""
+        if self.replay is None:
+            return datetime.now()
+        return self.replay.time
+
+    def update_history(self, live=True, verbose=False, ticks=None):
         
-        if not live:
-           iex = self.extract_tick()
+        if ticks is None and not live:
+            # replayed ticks come as arrays
+            times, exchanges, tickers, values = self.replay.next_arrays()
+            self.lastticks = None
         else:
-           iex = self.download_tick()
-        self.historysize = iex.shape[0]
-
-        # build order book 
-        self.orderbook = pd.DataFrame(columns=Book).set_index(['exchange', 'ticker'])
-        self.orderbook = self.orderbook.append(iex.set_index(['exchange', 'ticker']))
-        self.orderbook['mid'] = (self.orderbook['ask'] + self.orderbook['bid'])/2
-
-        # update price history 
-        self.history = self.history.append(iex.set_index(['time', 'exchange', 'ticker']))
-
-        # Ensure uniquess in price history
-        self.history = self.history[~self.history.index.duplicated(keep='first')]
-        # Remove old data in price history
-        self.history = self.history.iloc[-self.maxlookup*self.historysize:,:]
+            iex = ticks if ticks is not None else self.download_tick()
+            if iex.shape[0] == 0:
+                iex = pd.DataFrame(columns=Tick)
+            times = pd.to_datetime(iex['time']).to_numpy(dtype='datetime64[ns]').view('int64')
+            exchanges = iex['exchange'].to_numpy()
+            tickers = iex['ticker'].to_numpy()
+            values = iex[Fields].to_numpy(dtype='float64')
+            self.lastticks = iex
+        self.historysize = len(times)
+
+        # update quotes of the assets in the portfolio, the rest keep their last quote
+        if self.historysize > 0:
+            idx = np.array([self.assetindex.get(k, -1) for k in zip(exchanges, tickers)], dtype=int)
+            found = idx >= 0
+            self.bid[idx[found]] = values[found, 0]
+            self.ask[idx[found]] = values[found, 1]
+            np.add(self.bid, self.ask, out=self.mid)
+            self.mid /= 2
+
+            # update price history, ticks repeating the last timestamp of an asset are dropped
+            self.pricehistory.append_arrays(times, exchanges, tickers, values)
+            self.bars.append_arrays(times, exchanges, tickers, values[:, 0], values[:, 1])
 
         if verbose:
             print('Orderbook')
@@ -153,51 +258,54 @@ class Agent:
         """
         # add historical holdingshistory
         time_format = "%Y_%m_%d_%H_%M_%S"
-        now = datetime.now().strftime(time_format)
-        current_holdings = self.portfolio.transpose().set_index(np.array([now]))
-        current_holdings['porftoliovalue'] = self.portfoval
-        self.holdingshistory.append(current_holdings)
+        now = self.clock().strftime(time_format)
+        positions = self.rebalancer.positions.copy()
+        self.holdingshistory.append((now, positions, self.portfoval))
         # send results to pedlar
         if self.connection:
-            _payload = current_holdings.to_dict('record')[0] 
-            payload = dict([(k[0]+k[1],v) for k,v in _payload.items()])
+            payload = dict(zip(self.assetnames, positions.tolist()))
+            payload['porftoliovalue'] = self.portfoval
             # wrap current orderbook value to dictionary 
             user = {'user_id':self.username,'agent':self.agentname, 'tradesession':self.tradesession, 'time':now}
             payload.update(user)
-            r = requests.post(self.endpoint+"/portfolio/"+str(self.tradesession), json=payload)
-        # construct changes 
-        self.holdings_change = new_weights - self.portfolio
-        # perform orders wrt to cash 
-        # check asset allocation limit 
-        self.abspos = np.sum(np.abs(new_weights['volume']) * self.orderbook['mid']) + self.cash
-        if self.abspos > self.caplim:
-            raise ValueError('Portfolio allocation cannot exceed capital limit')
-        # check cash must be positive 
-        self.holdings_change['transact'] = np.where(self.holdings_change['volume']>0, self.orderbook.loc[self.holdings_change.index,:]['ask'],self.orderbook.loc[self.holdings_change.index,:]['bid']) * self.holdings_change['volume']
-        self.cash = self.cash - np.sum(self.holdings_change['transact'])
-        if self.cash < 0:
-            raise ValueError('Cash cannot be negative')
-        # update to target holdings 
-        self.portfolio = new_weights
+            self.uploader.put(payload)
+        # perform orders wrt to cash, raises if caplim is exceeded or cash turns negative
+        volume = new_weights['volume']
+        if not volume.index.equals(self.portfolioindex):
+            volume = volume.reindex(self.portfolioindex)
+        fill = self.rebalancer.rebalance(volume.to_numpy(dtype='float64'), self.bid, self.ask, self.mid, self.cash, self.caplim)
+        self.abspos = fill.abspos
+        self.cash = fill.cash
         if verbose:
             print('Transactions')
-            print(self.holdings_change)
+            print(pd.DataFrame({'volume': fill.volume, 'transact': fill.transact}, index=self.portfolioindex))
             print('')
-        return None 
+        return fill
 
     def save_record(self):
         # upload to pedlar server 
         if self.connection:
             payload = {'user_id':self.username,'agent':self.agentname, 'tradesession':self.tradesession, 'pnl':self.pnl, 'sharpe':self.sharpe}
-            r = requests.post(self.endpoint+"/tradesession", json=payload)
-            self.tradesession = r.json()['tradesession']
-        time_format = "%Y_%m_%d_%H_%M_%S" # datetime column format
-        timestamp = datetime.now().strftime(time_format)
+            # leaderboard is updated after all snapshots of the session are stored
+            self.uploader.flush()
+            self.tradesession = self.uploader.post("/tradesession", payload)['tradesession']
+        if self.holdingshistory:
+            times, positions, values = zip(*self.holdingshistory)
+            self.history_trades = pd.DataFrame(np.vstack(positions), index=np.array(times), columns=self.portfolioindex)
+        else:
+            values = []
+            self.history_trades = pd.DataFrame(columns=self.portfolioindex)
+        self.history_trades['porftoliovalue'] = list(values)
+        if self.recordformat == 'parquet':
+            # only the rows added since the last checkpoint are written
+            recorder = records.ParquetRecorder(self.recordpath)
+            recorder.write_prices(self.pricehistory.checkpoint(), self.agentname, self.tradesession, self.step)
+            recorder.write_holdings(self.history_trades, self.agentname, self.tradesession, self.step)
+            return None
         pricefilename = 'Historical_Price_{}_{}_Step_{}.csv'.format(self.agentname,self.tradesession,self.step)
         tradefilename = 'Portfolio_Holdings_{}_{}_Step_{}.csv'.format(self.agentname,self.tradesession,self.step)
         # save price history 
         self.history.to_csv(pricefilename)
-        self.history_trades = pd.concat(self.holdingshistory,axis=0)
         self.history_trades.to_csv(tradefilename)
         return None 
 
@@ -206,39 +314,43 @@ class Agent:
         time.sleep(n_seconds-dt.microsecond/1000000)
         return None
 
-    def run(self, live=True, verbose=False, backtestfile=None, n_seconds=5):
+    def default_backtestfile(self):
+        """Price records of earlier sessions, parquet dataset or csv files."""
+        prices = os.path.join(self.recordpath, 'prices')
+        if os.path.isdir(prices):
+            return prices
+        if glob.glob('Historical_Price_*.csv'):
+            return 'Historical_Price_*.csv'
+        raise ValueError('No recorded ticks in {} or Historical_Price_*.csv, pass backtestfile'.format(prices))
+
+    def run(self, live=True, verbose=False, backtestfile=None, n_seconds=5, record=True):
+        """
+        backtestfile: TickReplay or recorded tick files replayed when live is False,
+            defaults to the records written by save_record
+        record: save price and holdings history at the end of the session
+        """
 
         if live:
             self.connection = True
+            self.replay = None
         else:
             self.connection = False 
+            if backtestfile is None:
+                backtestfile = self.default_backtestfile()
+            if isinstance(backtestfile, TickReplay):
+                self.replay = backtestfile
+            else:
+                self.replay = TickReplay(backtestfile)
         
         self.start_agent(verbose)
         # starting portfolio with zero holding 
         new_weights = self.portfolio
 
         while self.step < self.maxsteps:
+            if not live and self.replay.exhausted:
+                break
             self.update_history(live=live,verbose=False)
-            # There is live data
-            if self.orderbook.shape[0] > 0:
-                self.rebalance(new_weights,verbose=verbose)
-                # Update capital limit 
-                self.portfoval = np.sum(self.portfolio['volume'] * self.orderbook['mid']) + self.cash
-                self.caplim = self.portfoval * 2 
-                # Run user provided function to get target portfolio weights for the next data
-                if not self.ondatauserparms:
-                    self.ondatauserparms = {}
-                new_weights = self.ondata(step=self.step, history=self.history, portfolio=self.portfolio, cash=self.cash, caplim=self.caplim,  **self.ondatauserparms)
-
-                # portfolio performance 
-                self.pnl = self.portfoval - self.startcash 
-                self.pnlhistory.append(self.portfoval)
-                if self.step >0:
-                    self.sharpe = portcalc.sharpe_ratio(self.pnlhistory)
-                else:
-                    self.sharpe = 0 
-
-            self.step += 1
+            new_weights = self.step_portfolio(new_weights, verbose)
 
             if live:
                 if self.step % self.maxlookup == (self.maxlookup-1):
@@ -248,15 +360,122 @@ class Agent:
                     self.delay(n_seconds)
                 else:
                     self.delay(n_seconds)
-            
-            if verbose:
-                print('Step {} {}'.format(self.step, self.portfoval))
-                print()
-                print('Orderbook')
-                print(self.orderbook)
-                print()
         # save record at the end of backtest
-        self.save_record()
+        self.end_session(record)
+
+    def step_portfolio(self, new_weights, verbose=False):
+        """Rebalance to new_weights on the current quotes and ask ondata for the next target."""
+        # There is live data
+        if self.historysize > 0:
+            self.rebalance(new_weights,verbose=verbose)
+            # Update capital limit 
+            self.portfoval = self.rebalancer.value(self.mid, self.cash)
+            self.caplim = self.portfoval * 2 
+            # Run user provided function to get target portfolio weights for the next data
+            if not self.ondatauserparms:
+                self.ondatauserparms = {}
+            new_weights = self.ondata(step=self.step, portfolio=self.portfolio, cash=self.cash, caplim=self.caplim, **self.ondata_history(), **self.ondatauserparms)
+
+            # portfolio performance 
+            self.pnl = self.portfoval - self.startcash 
+            self.pnlhistory.append(self.portfoval)
+            self.stats.update(self.portfoval)
+            self.sharpe = self.stats.sharpe()
+
+        self.step += 1
+        
+        if verbose:
+            print('Step {} {}'.format(self.step, self.portfoval))
+            print()
+            print('Orderbook')
+            print(self.orderbook)
+            print()
+        return new_weights
+
+    def end_session(self, record=True):
+        if record:
+            self.save_record()
+        if self.connection:
+            self.uploader.close()
+        if self.iexclient is not None:
+            self.iexclient.close()
+            self.iexclient = None
+        if self.truefxstream is not None:
+            self.truefxstream.close()
+            self.truefxstream = None
+
+    def stream_run(self, ticker="tcp://localhost:7000", trigger='ticks', every=1, connection=True,
+                   verbose=False, record=True, polltimeout=1000):
+        """
+        Event driven run on the ZMQ tick bus, the process is idle until ticks arrive.
+        Ticks are coalesced per symbol, keeping the latest one, between ondata calls.
+        trigger: 'ticks' calls ondata every `every` ticks, 'bar' when a tick starts a new
+        bar of `every` seconds and 'change' when the bid or ask of an asset changes
+        """
+        import zmq
+        if trigger not in ('ticks', 'bar', 'change'):
+            raise ValueError('trigger must be ticks, bar or change')
+        self.connection = connection
+        self.replay = None
+        self.start_agent(verbose)
+        new_weights = self.portfolio
+
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        tickbus.subscribe(socket, self.tickers)
+        socket.connect(ticker)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+
+        pending = dict() # latest frame of every symbol since the last ondata call
+        ntick = 0
+        bar = None
+        try:
+            while self.step < self.maxsteps:
+                if not poller.poll(polltimeout):
+                    continue
+                fire = False
+                # drain everything queued on the socket
+                while True:
+                    try:
+                        message = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    exchange, tick, frames = tickbus.decode(message)
+                    frame = frames[-1]
+                    pending[(exchange, tick)] = frame
+                    ntick += len(frames)
+                    if trigger == 'change':
+                        i = self.assetindex.get((exchange, tick))
+                        fire = fire or i is None or frame['bid'] != self.bid[i] or frame['ask'] != self.ask[i]
+                    elif trigger == 'bar':
+                        framebar = int(frame['time']) // int(every * 1000)
+                        fire = fire or (bar is not None and framebar > bar)
+                        bar = framebar if bar is None else max(bar, framebar)
+                if trigger == 'ticks':
+                    fire = ntick >= every
+                if not fire or not pending:
+                    continue
+                ntick = 0
+                frames = list(pending.items())
+                pending.clear()
+                ticks = pd.DataFrame({
+                    'time': (np.array([f['time'] for _, f in frames], dtype='int64') * 1000000).view('datetime64[ns]'),
+                    'exchange': [k[0] for k, _ in frames],
+                    'ticker': [k[1] for k, _ in frames],
+                    'bid': [f['bid'] for _, f in frames],
+                    'ask': [f['ask'] for _, f in frames],
+                    'bidsize': [f['bidsize'] for _, f in frames],
+                    'asksize': [f['asksize'] for _, f in frames],
+                }, columns=Tick)
+                self.update_history(ticks=ticks)
+                new_weights = self.step_portfolio(new_weights, verbose)
+                if self.connection and self.step % self.maxlookup == (self.maxlookup-1):
+                    self.save_record()
+                    self.holdingshistory = []
+                    self.pnlhistory = [] 
+        finally:
+            socket.close()
+        self.end_session(record)
 
 if __name__=='__main__':
 
@@ -12,6 +12,8 @@ import pandas as pd
 import requests
 import zmq
 
+import tickbus
+
 logger = logging.getLogger(__name__)
 logger.info("libzmq: %s", zmq.zmq_version())
 logger.info("pyzmq: %s", zmq.pyzmq_version())
@@ -278,6 +280,14 @@ class Agent:
       d = json.loads(tickdata)
       self.onIEX(d)
 
+    if pricingsource.startswith('IEX:'):
+      # binary tick frames published by iex_ws
+      _, ticker, frames = tickbus.decode([pricingsource.encode(), tickdata])
+      for frame in frames:
+        self.onIEX({'symbol': ticker, 'bidPrice': frame['bid'], 'askPrice': frame['ask'],
+                    'bidSize': frame['bidsize'], 'askSize': frame['asksize'],
+                    'lastUpdated': int(frame['time'])})
+
     if pricingsource == 'TrueFX':
       df = bytes2df(tickdata, truefxheader, truefxnames)
       df['Date'] = pd.to_datetime(df['Date'], unit='ms')
@@ -15,7 +15,9 @@ import requests
 
 # Datafeed functions 
 import iex
+import truefx
 import portcalc
+from fxcross import CrossRates
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +26,7 @@ logger = logging.getLogger(__name__)
 Holding =  ['exchange', 'ticker', 'volume']
 Tick = ['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize']
 Book = ['exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize', 'time']
+USD_based = ['GBP/USD','EUR/USD','JPY/USD','CHF/USD','CAD/USD','AUD/USD']
 
 
 class Agent:
@@ -94,6 +97,9 @@ class Agent:
         self.truefxsession_data = session_data
         self.truefxparse = flag_parse_data
         self.truefxauthorized = authrorize
+        # compile USD based views of the quoted pairs once
+        quoted = truefx.SYMBOLS_ALL if authrorize else truefx.SYMBOLS_NOT_AUTH
+        self.fxcross = CrossRates(quoted, USD_based)
         # connect to other datasource 
         # set up trading universe
         self.step = 0
@@ -126,16 +132,8 @@ class Agent:
     def download_tick(self):
         # implement methods to get price data in dataframes 
         truefxdata = truefx.read_tick(self.truefxsession, self.truefxsession_data, self.truefxparse, self.truefxauthorized) 
-        truefxdata.set_index('ticker',inplace=True)
-        Reverse_pairs = ['USD/CHF','USD/JPY','USD/CAD']
-        for p in Reverse_pairs:
-            pinv = p[4:7] + '/' + p[0:3]
-            truefxdata.loc[pinv,:] = truefxdata.loc[p,:]
-            truefxdata.loc[pinv,'bid'] = 1 / truefxdata.loc[p,'bid']
-            truefxdata.loc[pinv,'ask'] = 1 / truefxdata.loc[p,'ask']
-        USD_based = ['GBP/USD','EUR/USD','JPY/USD','CHF/USD','CAD/USD','AUD/USD']
-        truefxdata = truefxdata.loc[USD_based]
-        truefxdata.reset_index(inplace=True)
+        # inversions swap bid and ask, e.g. bid of JPY/USD is 1 / ask of USD/JPY
+        truefxdata = self.fxcross.compute(truefxdata)
         iexdata = iex.get_TOPS(self.iextickernames)
         return truefxdata, iexdata
 
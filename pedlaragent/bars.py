@@ -0,0 +1,110 @@
+"""Time bars built incrementally from ticks."""
+import pandas as pd
+import numpy as np
+
+from .pricehistory import RingBuffer
+
+# open, high, low and close are mid prices, spread is the average spread
+BarFields = ['open', 'high', 'low', 'close', 'spread', 'count']
+Index = ['time', 'exchange', 'ticker']
+
+
+class BarBuilder:
+    """Bars of one resolution for a single (exchange, ticker).
+
+    The bar being built is kept in scalars and moved into a fixed capacity
+    RingBuffer when a tick of a later bar arrives, so every tick is O(1).
+    """
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution # nanoseconds
+        self.bars = RingBuffer(capacity, len(BarFields))
+        self.current = None # start of the bar being built
+        self.values = np.zeros(len(BarFields))
+
+    def update(self, time, mid, spread):
+        start = time - time % self.resolution
+        values = self.values
+        if start != self.current:
+            if self.current is not None:
+                values[4] /= values[5]
+                self.bars.append(self.current, values)
+            self.current = start
+            values[:] = (mid, mid, mid, mid, spread, 1)
+            return None
+        if mid > values[1]:
+            values[1] = mid
+        if mid < values[2]:
+            values[2] = mid
+        values[3] = mid
+        values[4] += spread
+        values[5] += 1
+        return None
+
+
+class BarStore:
+    """Finished bars of every (exchange, ticker) at several resolutions.
+
+    resolutions are pandas offsets such as '1s', '1m' or '5min', at most
+    maxbars finished bars are kept per asset and resolution. Ticks older
+    than the last tick of their asset are ignored.
+    """
+
+    def __init__(self, resolutions=('1s', '1min', '5min'), maxbars=1000):
+        self.resolutions = list(resolutions)
+        self.nanos = [pd.Timedelta(r).value for r in self.resolutions]
+        self.maxbars = maxbars
+        self.builders = dict() # (exchange, ticker) -> list of BarBuilder
+        self.last = dict()
+
+    def append(self, ticks):
+        """Add a tick DataFrame with Tick columns."""
+        if ticks.shape[0] == 0:
+            return None
+        times = pd.to_datetime(ticks['time']).to_numpy(dtype='datetime64[ns]').view('int64')
+        bid = ticks['bid'].to_numpy(dtype='float64')
+        ask = ticks['ask'].to_numpy(dtype='float64')
+        return self.append_arrays(times, ticks['exchange'].to_numpy(), ticks['ticker'].to_numpy(), bid, ask)
+
+    def append_arrays(self, times, exchanges, tickers, bid, ask):
+        """Add ticks given as int64 nanosecond times and bid/ask arrays."""
+        mids = ((bid + ask) / 2).tolist()
+        spreads = (ask - bid).tolist()
+        for exchange, ticker, t, mid, spread in zip(exchanges, tickers, times.tolist(), mids, spreads):
+            key = (exchange, ticker)
+            last = self.last.get(key)
+            if last is not None and t <= last:
+                continue
+            self.last[key] = t
+            builders = self.builders.get(key)
+            if builders is None:
+                builders = self.builders[key] = [BarBuilder(n, self.maxbars) for n in self.nanos]
+            for builder in builders:
+                builder.update(t, mid, spread)
+        return None
+
+    def view(self, exchange, ticker, resolution):
+        """Zero-copy (times, values) of finished bars, values columns follow BarFields."""
+        builders = self.builders.get((exchange, ticker))
+        if builders is None:
+            return np.empty(0, dtype='int64'), np.empty((0, len(BarFields)))
+        return builders[self.resolutions.index(resolution)].bars.view()
+
+    def frame(self, resolution):
+        """Finished bars of every asset indexed by (time, exchange, ticker)."""
+        i = self.resolutions.index(resolution)
+        times, values, exchanges, tickers = [], [], [], []
+        for (exchange, ticker), builders in self.builders.items():
+            t, v = builders[i].bars.view()
+            times.append(t)
+            values.append(v)
+            exchanges.append(np.full(len(t), exchange, dtype=object))
+            tickers.append(np.full(len(t), ticker, dtype=object))
+        if not times:
+            return pd.DataFrame(columns=Index + BarFields).set_index(Index)
+        times = np.concatenate(times)
+        order = np.argsort(times, kind='stable')
+        index = pd.MultiIndex.from_arrays([pd.to_datetime(times[order]),
+                                           np.concatenate(exchanges)[order],
+                                           np.concatenate(tickers)[order]], names=Index)
+        return pd.DataFrame(np.concatenate(values)[order], index=index, columns=BarFields)
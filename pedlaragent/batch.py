@@ -0,0 +1,110 @@
+"""Run many agent configurations against the same recorded ticks in parallel."""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import logging
+from multiprocessing import shared_memory
+
+import pandas as pd
+import numpy as np
+
+from .agent import Agent
+from .replay import TickReplay, read_ticks
+
+logger = logging.getLogger(__name__)
+
+TickRecord = np.dtype([('time', 'int64'), ('exchange', 'int32'), ('ticker', 'int32'),
+                       ('bid', 'float64'), ('ask', 'float64'), ('bidsize', 'float64'), ('asksize', 'float64')])
+
+# shared memory blocks attached by this worker and replays built on them,
+# keyed by (block name, freq) so every configuration reuses the same arrays
+_worker_blocks = dict()
+_worker_replays = dict()
+
+
+def param_grid(ondatafunc, params):
+    """Agent configurations for every combination of the params lists.
+
+    ondatafunc must be a module level function so it can be pickled.
+    """
+    names = sorted(params)
+    return [dict(ondatafunc=ondatafunc, ondataparams=dict(zip(names, values)))
+            for values in itertools.product(*[params[n] for n in names])]
+
+
+def share_ticks(ticks):
+    """Copy ticks into a shared memory block, returns (block, spec).
+
+    spec is the picklable description workers use to attach.
+    """
+    exchanges = pd.Categorical(ticks['exchange'])
+    tickers = pd.Categorical(ticks['ticker'])
+    block = shared_memory.SharedMemory(create=True, size=max(TickRecord.itemsize * len(ticks), 1))
+    records = np.ndarray(len(ticks), dtype=TickRecord, buffer=block.buf)
+    records['time'] = ticks['time'].to_numpy(dtype='datetime64[ns]').view('int64')
+    records['exchange'] = exchanges.codes
+    records['ticker'] = tickers.codes
+    for col in ['bid', 'ask', 'bidsize', 'asksize']:
+        records[col] = ticks[col].to_numpy(dtype='float64')
+    del records
+    spec = (block.name, len(ticks), list(exchanges.categories), list(tickers.categories))
+    return block, spec
+
+
+def attach_ticks(spec, freq=None):
+    """TickReplay on views of a shared memory block, cached per process.
+
+    Only the exchange and ticker names are materialized, times and prices
+    are read straight from the block, which stays attached until the
+    worker exits. Call fork() on the result before replaying it.
+    """
+    name, n, exchanges, tickers = spec
+    if (name, freq) not in _worker_replays:
+        if name not in _worker_blocks:
+            _worker_blocks[name] = shared_memory.SharedMemory(name=name)
+        block = _worker_blocks[name]
+        records = np.ndarray(n, dtype=TickRecord, buffer=block.buf)
+        # bid, ask, bidsize and asksize are adjacent float64 fields of every record
+        values = np.ndarray((n, 4), dtype='float64', buffer=block.buf, offset=TickRecord.fields['bid'][1],
+                            strides=(TickRecord.itemsize, 8))
+        _worker_replays[(name, freq)] = TickReplay.from_arrays(
+            records['time'], np.asarray(exchanges, dtype=object)[records['exchange']],
+            np.asarray(tickers, dtype=object)[records['ticker']], values, freq)
+    return _worker_replays[(name, freq)]
+
+
+def run_config(spec, universe, config, maxsteps, freq=None):
+    """Backtest one agent configuration, returns a leaderboard row."""
+    agent = Agent(universe=universe, maxsteps=maxsteps, **config)
+    row = {'agent': agent.agentname}
+    row.update(agent.ondatauserparms or {})
+    try:
+        agent.run(live=False, backtestfile=attach_ticks(spec, freq).fork(), record=False)
+        row.update(steps=agent.step, pnl=agent.pnl, sharpe=agent.sharpe, sortino=agent.stats.sortino(),
+                   maxdrawdown=agent.stats.maxdrawdown, hitrate=agent.stats.hitrate, error='')
+    except Exception as e:
+        row.update(error=str(e))
+    return row
+
+
+def run_batch(universe, source, configs, maxsteps=1000000, freq=None, max_workers=None):
+    """Backtest configs over a process pool and collect a leaderboard.
+
+    universe: list of (exchange, ticker) shared by all agents
+    source: recorded ticks, see replay.read_ticks
+    configs: list of Agent keyword arguments, e.g. from param_grid
+    """
+    ticks = read_ticks(source)
+    block, spec = share_ticks(ticks)
+    rows = []
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_config, spec, universe, config, maxsteps, freq) for config in configs]
+            for future in as_completed(futures):
+                rows.append(future.result())
+    finally:
+        block.close()
+        block.unlink()
+    leaderboard = pd.DataFrame(rows)
+    if 'sharpe' in leaderboard.columns:
+        leaderboard = leaderboard.sort_values('sharpe', ascending=False, na_position='last').reset_index(drop=True)
+    return leaderboard
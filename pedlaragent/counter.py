@@ -0,0 +1,42 @@
+"""Atomic trade session id allocation on a Mongo counter document."""
+import threading
+
+
+class SessionCounter:
+    """Hand out unique ids from a counter document.
+
+    The counter holds the last allocated id and is advanced with a single
+    find_one_and_update $inc, so concurrent processes never receive the
+    same id. With blocksize > 1 a process reserves blocksize ids per round
+    trip and hands them out locally. seedfunc, if given, returns the value
+    to seed the counter with and is called once, on the first allocation.
+    """
+
+    def __init__(self, collection, query=None, field='counter', blocksize=1, seedfunc=None):
+        self.collection = collection
+        self.query = query or {}
+        self.field = field
+        self.blocksize = blocksize
+        self.seedfunc = seedfunc
+        self.lock = threading.Lock()
+        self.next = 0
+        self.end = 0
+
+    def seed(self, value):
+        """Make sure the counter is at least value, e.g. existing records."""
+        self.collection.update_one(self.query, {'$max': {self.field: value}}, upsert=True)
+
+    def allocate(self):
+        with self.lock:
+            if self.seedfunc is not None:
+                self.seed(self.seedfunc())
+                self.seedfunc = None
+            if self.next >= self.end:
+                # return_document=True is ReturnDocument.AFTER
+                doc = self.collection.find_one_and_update(self.query, {'$inc': {self.field: self.blocksize}},
+                                                          upsert=True, return_document=True)
+                self.end = doc[self.field] + 1
+                self.next = self.end - self.blocksize
+            allocated = self.next
+            self.next += 1
+            return allocated
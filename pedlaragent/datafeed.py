@@ -9,6 +9,8 @@
 from arctic import Arctic
 
 import arctic
+from arctic.date import DateRange
+from arctic.chunkstore.chunkstore import ChunkStore
 
 import os 
 import pymongo
@@ -21,6 +23,12 @@ import datetime
 import random
 
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 def _prasename(x):
     import re
@@ -55,49 +63,120 @@ def list_folders(currentpath):
 def mongoclient(url):
     return pymongo.MongoClient(url)
 
-def csv2mongo(client,dbname,collectionname,filename):
-
+def csv2mongo(client,dbname,collectionname,filename,keys=('time','exchange','ticker'),chunksize=10000,retries=3):
+    # read the csv chunk by chunk so memory stays bounded by chunksize rows
+    # the index is created with the first chunk only
+    uploaded=True
     try:
-        db = client.get_database(dbname)
-        db_cm = db[collectionname]
-        tlist = pd.read_csv(filename)
-        db_cm.insert_many(tlist.to_dict('records'))
-    except:
+        for i,df in enumerate(pd.read_csv(filename,chunksize=chunksize)):
+            uploaded=df2mongo(client,dbname,collectionname,df,keys,chunksize,retries,index=i==0) and uploaded
+    except Exception:
+        uploaded=False
+    if not uploaded:
         print('File not uploaded ', filename)
+    return uploaded
 
-def df2mongo(client,dbname,collectionname,df):
-
+def mongoindex(client,dbname,collectionname,keys):
+    # unique index on the upsert keys, collections already holding duplicates
+    # get a plain compound index so upserts still find their document without a scan
+    db = client.get_database(dbname)
+    index=[(k,pymongo.ASCENDING) for k in keys]
     try:
-        db = client.get_database(dbname)
-        db_cm = db[collectionname]
-        db_cm.insert_many(df.to_dict('records'))
-    except:
+        db[collectionname].create_index(index,unique=True)
+    except pymongo.errors.PyMongoError:
+        logging.warning('Unique index not created, collection holds duplicates '+collectionname)
+        db[collectionname].create_index(index)
+
+def df2mongo(client,dbname,collectionname,df,keys=('time','exchange','ticker'),chunksize=10000,retries=3,index=True):
+    # upsert documents keyed on keys so uploading the same rows twice is harmless
+    # keys missing from df are ignored, without any key rows are inserted
+    db = client.get_database(dbname)
+    db_cm = db[collectionname]
+    keys=[k for k in keys if k in df.columns]
+    if keys and index:
+        mongoindex(client,dbname,collectionname,keys)
+    # upserts are idempotent so a partly applied chunk can be retried,
+    # retrying inserts would duplicate the rows that made it
+    attempts=retries if keys else 1
+    uploaded=True
+    for start in range(0,df.shape[0],chunksize):
+        records=df.iloc[start:start+chunksize].to_dict('records')
+        if keys:
+            ops=[pymongo.UpdateOne(dict((k,r[k]) for k in keys),{'$set':r},upsert=True) for r in records]
+        else:
+            ops=[pymongo.InsertOne(r) for r in records]
+        for attempt in range(attempts):
+            try:
+                # unordered so the server applies the whole chunk in parallel
+                db_cm.bulk_write(ops,ordered=False)
+                break
+            except pymongo.errors.PyMongoError as e:
+                logging.warning('Chunk {} of {} failed: {}'.format(start,collectionname,e))
+        else:
+            uploaded=False
+    if not uploaded:
         print('Not uploaded ', dbname,collectionname)
+    return uploaded
         
+def mongoquery(start=None,end=None,symbols=None,timefield='time',symbolfield='ticker'):
+    # filter documents on the server, start and end must have the type of the stored timefield
+    query={}
+    if start is not None or end is not None:
+        query[timefield]={}
+        if start is not None:
+            query[timefield]['$gte']=start
+        if end is not None:
+            query[timefield]['$lte']=end
+    if symbols is not None:
+        query[symbolfield]={'$in':list(symbols)}
+    return query
+
+def mongobatches(client,dbname,collectionname,start=None,end=None,symbols=None,columns=None,
+                 timefield='time',symbolfield='ticker',batchsize=10000):
+    # yield dataframes of at most batchsize documents, only the projected columns are sent
+    db = client.get_database(dbname)
+    query=mongoquery(start,end,symbols,timefield,symbolfield)
+    projection={'_id':0}
+    if columns is not None:
+        projection.update(dict((c,1) for c in columns))
+    cursor=db[collectionname].find(query,projection).batch_size(batchsize)
+    if start is not None or end is not None:
+        cursor=cursor.sort(timefield,pymongo.ASCENDING)
+    batch=[]
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch)>=batchsize:
+            yield pd.DataFrame(batch,columns=columns)
+            batch=[]
+    if batch:
+        yield pd.DataFrame(batch,columns=columns)
+
 # Read dataframe from mongo, used for pricing data,
-def mongo2df(client,dbname,collectionname):
+def mongo2df(client,dbname,collectionname,start=None,end=None,symbols=None,columns=None,
+             timefield='time',symbolfield='ticker',batchsize=10000,dedupe=True):
     
-    db = client.get_database(dbname)
-    df = pd.DataFrame(list(db[collectionname].find({})))
-    try:
-        df.drop(['_id'], axis=1,inplace=True)
-        df.drop_duplicates(keep='last', inplace=True)
-    except:
+    frames=list(mongobatches(client,dbname,collectionname,start,end,symbols,columns,timefield,symbolfield,batchsize))
+    if not frames:
         print('Record not found',collectionname)
+        return pd.DataFrame(columns=columns)
+    df=pd.concat(frames,axis=0,ignore_index=True)
+    if dedupe:
+        # collections filled by insert_many may hold repeated documents
+        df.drop_duplicates(keep='last', inplace=True)
     return df 
 
-def mongo2csv(client,dbname,collectionname,filepath):
-    
-    db = client.get_database(dbname)
-    df = pd.DataFrame(list(db[collectionname].find({})))
-    try:
-        df.drop(['_id'], axis=1,inplace=True)
+def mongo2csv(client,dbname,collectionname,filepath,start=None,end=None,symbols=None,columns=None,
+              timefield='time',symbolfield='ticker',batchsize=10000):
+    # write batch by batch so the collection never has to fit in memory, returns rows written
+    rows=0
+    for df in mongobatches(client,dbname,collectionname,start,end,symbols,columns,timefield,symbolfield,batchsize):
         df.drop_duplicates(keep='last', inplace=True)
-        df.to_csv(filepath,index=False)
-    except:
+        df.to_csv(filepath,index=False,mode='w' if rows==0 else 'a',header=rows==0)
+        rows+=df.shape[0]
+    if rows==0:
         print('Record not found',collectionname)
     client.close()
-    return df 
+    return rows 
 
 
 def mongo2mongo(client1,dbname1,collectionname1,client2,dbname2,collectionname2):
@@ -107,41 +186,102 @@ def mongo2mongo(client1,dbname1,collectionname1,client2,dbname2,collectionname2)
 def arctichost(host):
     return Arctic(host)
 
-# Download data to arctic db, try to append to existing table or create a bigger table 
-def df2arctic(df,store,arcticcollectionname,ticker):
-    # download df from mongo
-    # remove duplicate documents(rows)
-    # try to append to exisiting table in arctic 
-    # if not possible then merge the existing tables to form a bigger table
+def normalizearctic(df,columns=None,indexname=None):
+    # sorted unique datetime index, fixed column order and float numbers so consecutive appends line up
+    # tick frames indexed by row number are indexed by their time column instead
+    if not isinstance(df.index,pd.DatetimeIndex):
+        if 'time' in df.columns:
+            df=df.set_index('time')
+        elif pd.api.types.is_numeric_dtype(df.index):
+            raise ValueError('Arctic frames need a datetime index or a time column')
+    df=df.copy()
+    df.index=pd.to_datetime(df.index)
+    df.sort_index(kind='mergesort',inplace=True)
+    df=df[~df.index.duplicated(keep='last')]
+    if columns is not None:
+        df=df.reindex(columns=list(columns)+[c for c in df.columns if c not in columns])
+    for c in df.columns:
+        if pd.api.types.is_numeric_dtype(df[c]) and not pd.api.types.is_bool_dtype(df[c]):
+            df[c]=df[c].astype('float64')
+    if indexname is not None:
+        df.index.name=indexname
+    return df
+
+# Download data to arctic db, append new rows and only rewrite the periods they overlap
+def df2arctic(df,store,arcticcollectionname,ticker,chunk_size='D'):
+    # new libraries are chunk stores with one chunk per chunk_size period (a day by default)
+    # chunk stores rewrite only the chunks the incoming rows fall in
+    # existing version store libraries append when the rows are newer than the stored ones
+    # and fall back to the full merge only when they overlap
     
     # Create library if not exist
     try:
         library = store[arcticcollectionname]
     except:
-        store.initialize_library(arcticcollectionname)       
+        store.initialize_library(arcticcollectionname,lib_type=arctic.CHUNK_STORE)       
     library = store[arcticcollectionname]
 
-    # trying to append the data 
     try:
-        library.append(ticker,df, metadata={'lastupdate': datetime.datetime.now()})
+        if isinstance(library,ChunkStore):
+            df=normalizearctic(df,indexname='date')
+            if library.has_symbol(ticker):
+                _chunkstore_merge(library,ticker,df)
+            else:
+                library.write(ticker,df,metadata=_arcticmetadata(df),chunk_size=chunk_size)
+        elif not library.has_symbol(ticker):
+            df=normalizearctic(df)
+            library.write(ticker,df,metadata=_arcticmetadata(df))
+        else:
+            metadata=library.read_metadata(ticker).metadata or {}
+            df=normalizearctic(df,metadata.get('columns'))
+            lastindex=metadata.get('lastindex')
+            if lastindex is not None and df.index[0]>lastindex:
+                library.append(ticker,df,metadata=_arcticmetadata(df))
+            else:
+                # Merge with the old dataframe, new rows win
+                olddf=library.read(ticker).data
+                newdf=normalizearctic(pd.concat([olddf,df],axis=0),indexname=olddf.index.name)
+                library.write(ticker,newdf,metadata=_arcticmetadata(newdf))
         downloaded=True
     except:
-        # Try to merge with the old dataframe
-        try:
-            temp=library.read(ticker)
-            olddf=temp.data  
-            indexname=olddf.index.name
-            olddf.reset_index(inplace=True)
-            df.reset_index(inplace=True)
-            newdf=olddf.merge(df,how='outer')
-            newdf.set_index(indexname,inplace=True)
-            library.write(ticker,newdf, metadata={'lastupdate': datetime.datetime.now()})
-            downloaded=True
-        except:
-            logging.warning(ticker,' not updated')
-            downloaded=False
+        logging.warning(ticker+' not updated')
+        downloaded=False
     return [downloaded,ticker]
 
+def _chunkstore_lastindex(library,ticker):
+    # kept in the symbol metadata, symbols written elsewhere read their last chunk instead
+    metadata=library.read_metadata(ticker) or {}
+    if metadata.get('lastindex') is not None:
+        return pd.Timestamp(metadata['lastindex'])
+    for start,end in library.get_chunk_ranges(ticker,reverse=True):
+        start,end=[x.decode() if isinstance(x,bytes) else x for x in (start,end)]
+        last=library.read(ticker,chunk_range=DateRange(start,end))
+        if last.shape[0]:
+            return pd.Timestamp(last.index.max())
+    return None
+
+def _chunkstore_merge(library,ticker,df):
+    # rows after the stored ones are appended, the chunks holding older rows
+    # are read back, merged with them (new rows win) and rewritten
+    lastindex=_chunkstore_lastindex(library,ticker)
+    if lastindex is None:
+        older,newer=df.iloc[0:0],df
+    else:
+        older,newer=df[df.index<=lastindex],df[df.index>lastindex]
+    if older.shape[0]:
+        chunk_size=library.get_info(ticker).get('chunk_size','D')
+        chunkrange=DateRange(older.index[0].to_period(chunk_size).start_time,older.index[-1].to_period(chunk_size).end_time)
+        olddf=library.read(ticker,chunk_range=chunkrange)
+        merged=normalizearctic(pd.concat([olddf,older],axis=0),indexname='date')
+        library.update(ticker,merged,chunk_range=chunkrange)
+    if newer.shape[0]:
+        library.append(ticker,newer)
+    last=df.index[-1] if lastindex is None else max(lastindex,df.index[-1])
+    library.write_metadata(ticker,{'lastupdate': datetime.datetime.now(),'lastindex':last.to_pydatetime(),'columns':list(df.columns)})
+
+def _arcticmetadata(df):
+    return {'lastupdate': datetime.datetime.now(),'lastindex':df.index[-1].to_pydatetime(),'columns':list(df.columns)}
+
 # Move data between arctic collections with option to drop duplicates
 def arctic2arctic(store1,arcticcollectionname1,ticker1,store2,arcticcollectionname2,ticker2,cleandata=True):
         
@@ -152,18 +292,33 @@ def arctic2arctic(store1,arcticcollectionname1,ticker1,store2,arcticcollectionna
         store2.initialize_library(arcticcollectionname2)
     library2=store2[arcticcollectionname2]
 
-    df=library1.read(ticker1).data
+    df=arctic2df(store1,arcticcollectionname1,ticker1)
     if cleandata:
         newdf=df.drop_duplicates(keep='last')
     else:
         newdf=df
+    if isinstance(library2,ChunkStore):
+        # chunk stores index rows by date
+        newdf=newdf.rename_axis('date')
     library2.write(ticker2,newdf, metadata={'source': 'QT'})
 
 # read historical data from arctic 
-def arctic2df(store,arcticcollectionname,ticker,start=None,end=None):
+def arctic2df(store,arcticcollectionname,ticker,start=None,end=None,columns=None):
     # if start and end not provided, get the whole series
     # if end not provided, assume to get to latest data
-    df=store[arcticcollectionname].read(ticker).data
+    # date_range and columns are applied by arctic so only the matching chunks are read
+    kwargs={}
+    library=store[arcticcollectionname]
+    if start is not None or end is not None:
+        if isinstance(library,ChunkStore):
+            kwargs['chunk_range']=DateRange(start,end)
+        else:
+            kwargs['date_range']=DateRange(start,end)
+    if columns is not None:
+        kwargs['columns']=list(columns)
+    # chunk stores return the frame itself
+    item=library.read(ticker,**kwargs)
+    df=item if isinstance(library,ChunkStore) else item.data
     return df 
     
 # =============================================================================
@@ -184,39 +339,65 @@ def arcticclean(store,collection):
         library.delete(sec)
         print('Security is deleted: ',sec)
         
-def arctic_list_all_document(store,collectionname,download=False,path='ArcticData/',cleanup=False):
+def arctic_export_document(library,collectionname,sec,download=False,path='ArcticData/',cleanup=False,fileformat='parquet'):
+    # clean and export a single symbol, returns the number of rows
+    item=library.read(sec)
+    df=item if isinstance(library,ChunkStore) else item.data
+    if not download:
+        logging.info(collectionname+' '+sec)
+    if cleanup:
+        df=df.drop_duplicates()
+        df=df.sort_index()
+        if collectionname=='iex':
+            try:
+                df=iex_preprocessing(df)
+            except:
+                logging.warning('Preprocess error '+collectionname+' '+sec)
+        if isinstance(library,ChunkStore):
+            library.write(sec,df)
+        else:
+            library.write(sec,df, metadata={'lastupdate': datetime.datetime.now()})
+        logging.info('Updated '+collectionname+' '+sec)
+    if download:
+        # the cleaned frame is exported as is, no need to read it back
+        try:
+            filename=path+_prasename(collectionname)+'_'+_prasename(sec)
+            if fileformat=='parquet':
+                df.to_parquet(filename+'.parquet',compression='zstd')
+            else:
+                df.to_csv(filename+'.csv.gz',compression='gzip')
+        except:
+            logging.warning('Security name '+sec+' Collection '+collectionname+' not downloaded')
+    return df.shape[0]
+
+def arctic_list_all_document(store,collectionname,download=False,path='ArcticData/',cleanup=False,workers=4,fileformat=None):
+    # symbols of a library are exported by up to workers threads, the time is spent waiting on mongo
+    if fileformat is None:
+        fileformat='csv' if pyarrow is None else 'parquet'
     library=store[collectionname]
     symbollist=library.list_symbols()
-    for sec in symbollist:
-        ts=library.read(sec)
-        df=ts.data
-        if not download:
-            logging.info(collectionname+' '+sec)
-        if cleanup:
-            df.drop_duplicates(inplace=True)
-            df.sort_index(inplace=True)
-            if collectionname=='iex':
-                try:
-                    df=iex_preprocessing(df)
-                except:
-                    logging.warning('Preprocess error '+collectionname+' '+sec)
-            library.write(sec,df, metadata={'lastupdate': datetime.datetime.now()})
-            logging.info('Updated '+collectionname+' '+sec)
-        if download:
-            if cleanup:
-                df=library.read(sec).data
+    started=time.time()
+    rows=0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures=dict((pool.submit(arctic_export_document,library,collectionname,sec,download,path,cleanup,fileformat),sec) for sec in symbollist)
+        for i,future in enumerate(as_completed(futures)):
             try:
-                filename=path+_prasename(collectionname)+'_'+_prasename(sec)+'.csv'
-                df.to_csv(filename)
+                rows+=future.result()
             except:
-                logging.warning('Security name '+sec+' Collection '+collectionname+' not downloaded')
+                logging.warning('Security name '+futures[future]+' Collection '+collectionname+' not exported')
+            elapsed=time.time()-started
+            logging.info('{} {}/{} symbols {} rows {:.0f} rows/s'.format(collectionname,i+1,len(symbollist),rows,rows/max(elapsed,1e-9)))
+    return rows
 
 
-def arctic_list_all(store,download=False,path='ArcticData/',cleanup=False):
+def arctic_list_all(store,download=False,path='ArcticData/',cleanup=False,libraries=2,workers=4,fileformat=None):
+    # up to libraries libraries at once, each with at most workers symbols in flight
     if not os.path.exists(path):
         os.makedirs(path)
-    for i in store.list_libraries():
-        arctic_list_all_document(store,i,download,path,cleanup)
+    with ThreadPoolExecutor(max_workers=libraries) as pool:
+        futures=[pool.submit(arctic_list_all_document,store,i,download,path,cleanup,workers,fileformat) for i in store.list_libraries()]
+        rows=sum(f.result() for f in futures)
+    return rows
 
 def mongo_list_all_document(client,dbname,collectionname):
     return None
@@ -0,0 +1,96 @@
+"""FX inversions and cross rates computed from a fixed set of quoted pairs."""
+from collections import deque
+
+import pandas as pd
+import numpy as np
+
+
+def _legs(quoted, base, quote):
+    """Shortest chain of quoted pairs converting base into quote.
+
+    Returns a list of (pair, inverted) or None if there is no path.
+    """
+    graph = dict()
+    for pair in quoted:
+        a, b = pair.split('/')
+        graph.setdefault(a, []).append((b, pair, False))
+        graph.setdefault(b, []).append((a, pair, True))
+    previous = {base: None}
+    todo = deque([base])
+    while todo:
+        ccy = todo.popleft()
+        if ccy == quote:
+            break
+        for nxt, pair, inverted in graph.get(ccy, []):
+            if nxt not in previous:
+                previous[nxt] = (ccy, pair, inverted)
+                todo.append(nxt)
+    if quote not in previous:
+        return None
+    legs = []
+    ccy = quote
+    while previous[ccy] is not None:
+        ccy, pair, inverted = previous[ccy]
+        legs.append((pair, inverted))
+    return legs[::-1]
+
+
+class CrossRates:
+    """Conversion graph compiled once for the requested pairs.
+
+    Every requested pair is a product of at most maxlegs quoted pairs,
+    each used directly or inverted. Inverting swaps the sides, the bid
+    of B/A is 1 / ask of A/B. compute then prices every requested pair
+    in one vectorized pass over the quote arrays.
+    """
+
+    def __init__(self, quoted, requested):
+        self.quoted = list(quoted)
+        self.requested = list(requested)
+        self.index = dict((p, i) for i, p in enumerate(self.quoted))
+        paths = []
+        for pair in self.requested:
+            base, quote = pair.split('/')
+            legs = _legs(self.quoted, base, quote)
+            if legs is None:
+                raise ValueError('No conversion path for {}'.format(pair))
+            paths.append(legs)
+        self.maxlegs = max([len(legs) for legs in paths] + [1])
+        # unused legs point at a sentinel quote of 1
+        sentinel = len(self.quoted)
+        self.legs = np.full((len(paths), self.maxlegs), sentinel, dtype=int)
+        self.inverted = np.zeros((len(paths), self.maxlegs), dtype=bool)
+        for i, legs in enumerate(paths):
+            for j, (pair, inverted) in enumerate(legs):
+                self.legs[i, j] = self.index[pair]
+                self.inverted[i, j] = inverted
+        # pairs not quoted yet price as NaN rather than 1
+        self.bid = np.full(sentinel + 1, np.nan)
+        self.ask = np.full(sentinel + 1, np.nan)
+        self.bid[sentinel] = self.ask[sentinel] = 1
+        self.time = np.zeros(sentinel + 1, dtype='int64')
+
+    def update(self, ticks):
+        """Load quotes of the quoted pairs from a TrueFX tick frame."""
+        idx = np.array([self.index.get(t, -1) for t in ticks['ticker']], dtype=int)
+        found = idx >= 0
+        self.bid[idx[found]] = ticks['bid'].to_numpy(dtype='float64')[found]
+        self.ask[idx[found]] = ticks['ask'].to_numpy(dtype='float64')[found]
+        self.time[idx[found]] = ticks['time'].to_numpy(dtype='datetime64[ns]').view('int64')[found]
+        return None
+
+    def compute(self, ticks=None):
+        """Tick frame of the requested pairs, timed by their latest leg."""
+        if ticks is not None:
+            self.update(ticks)
+        legbid = np.where(self.inverted, 1 / self.ask[self.legs], self.bid[self.legs])
+        legask = np.where(self.inverted, 1 / self.bid[self.legs], self.ask[self.legs])
+        return pd.DataFrame({
+            'time': self.time[self.legs].max(axis=1).view('datetime64[ns]'),
+            'exchange': 'TrueFX',
+            'ticker': self.requested,
+            'bid': legbid.prod(axis=1),
+            'ask': legask.prod(axis=1),
+            'bidsize': 100,
+            'asksize': 100,
+        }, columns=['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize'])
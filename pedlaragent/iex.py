@@ -3,12 +3,19 @@ import datetime
 import csv
 import time
 import json 
+import asyncio
+import threading
 
 import requests
 
 import pandas as pd
 import numpy as np
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 iexbaseurl = 'https://api.iextrading.com/1.0'
 
 def get_TOPS(tickerstring):
@@ -26,6 +33,91 @@ def get_TOPS(tickerstring):
     else:
         return pd.DataFrame(columns=['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize'])
 
+class TOPSClient:
+    """Poll IEX TOPS for a fixed universe over a keep-alive connection pool.
+
+    Symbols are split into batches that keep every url under maxurl
+    characters and the batches are fetched concurrently. Quotes are
+    parsed straight into arrays preallocated for the universe. The client
+    runs its own event loop on a background thread, so get_TOPS works from
+    synchronous code and from threads that already run a loop, e.g. Jupyter
+    and Colab. poll must only be awaited on the client's loop.
+    """
+
+    def __init__(self, tickers, baseurl=iexbaseurl, maxurl=2000, limit=10):
+        if aiohttp is None:
+            raise ImportError('TOPSClient requires aiohttp')
+        self.tickers = list(tickers)
+        self.index = dict((t, i) for i, t in enumerate(self.tickers))
+        self.urls = []
+        prefix = baseurl + '/tops?symbols='
+        batch = []
+        for t in self.tickers:
+            if batch and len(prefix) + len(','.join(batch + [t])) > maxurl:
+                self.urls.append(prefix + ','.join(batch))
+                batch = []
+            batch.append(t)
+        if batch:
+            self.urls.append(prefix + ','.join(batch))
+        n = len(self.tickers)
+        self.time = np.zeros(n, dtype='int64')
+        self.bid = np.zeros(n)
+        self.ask = np.zeros(n)
+        self.bidsize = np.zeros(n)
+        self.asksize = np.zeros(n)
+        self.seen = np.zeros(n, dtype=bool)
+        self.limit = limit
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='iex-tops', daemon=True)
+        self._thread.start()
+        self.session = None
+
+    async def _fetch(self, url):
+        async with self.session.get(url) as r:
+            data = await r.json(content_type=None)
+        for quote in data or []:
+            i = self.index.get(quote.get('symbol'))
+            if i is None:
+                continue
+            self.time[i] = quote.get('lastUpdated') or 0
+            self.bid[i] = quote.get('bidPrice', np.nan)
+            self.ask[i] = quote.get('askPrice', np.nan)
+            self.bidsize[i] = quote.get('bidSize', np.nan)
+            self.asksize[i] = quote.get('askSize', np.nan)
+            self.seen[i] = True
+
+    async def poll(self):
+        """Fetch all batches and return the quotes as a TOPS DataFrame."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit))
+        self.seen[:] = False
+        await asyncio.gather(*[self._fetch(url) for url in self.urls])
+        return self.frame()
+
+    def frame(self):
+        idx = np.flatnonzero(self.seen)
+        return pd.DataFrame({
+            'time': (self.time[idx] * 1000000).view('datetime64[ns]'),
+            'exchange': 'IEX',
+            'ticker': [self.tickers[i] for i in idx],
+            'bid': self.bid[idx],
+            'ask': self.ask[idx],
+            'bidsize': self.bidsize[idx],
+            'asksize': self.asksize[idx],
+        }, columns=['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize'])
+
+    def get_TOPS(self):
+        """Synchronous poll, same output as get_TOPS."""
+        return asyncio.run_coroutine_threadsafe(self.poll(), self.loop).result()
+
+    def close(self):
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
 if __name__=='__main__':
     get_TOPS('FB,APPL')
 
@@ -5,9 +5,13 @@ from socketIO_client_nexus import SocketIO, BaseNamespace
 import json
 import zmq
 
+from tickbus import TickPublisher
+
 
 _SIO_URL_PREFIX = 'https://ws-api.iextrading.com'
 _SIO_PORT = 443
+# json messages as published before tick frames, tick topics never equal it
+_LEGACY_TOPIC = b'IEX'
 
 
 def _tryJson(data, raw=True):
@@ -21,11 +25,12 @@ def _tryJson(data, raw=True):
 
 
 class WSClient(object):
-    def __init__(self, addr, tickers=None, on_data=None, on_open=None, on_close=None, raw=False, tcp='tcp://127.0.0.1:7000'):
+    def __init__(self, addr, tickers=None, on_data=None, on_open=None, on_close=None, raw=False, tcp='tcp://127.0.0.1:7000', batchsize=1):
         '''
            addr: path to sio
            sendinit: tuple to emit
            on_data, on_open, on_close: functions to call
+           batchsize: number of frames of a symbol sent per message
        '''
 
         # Socket to talk to server
@@ -34,6 +39,9 @@ class WSClient(object):
         zmqsocket = context.socket(zmq.PUB)
         zmqsocket.connect(tcp)
         print('IEX publisher connect to port 7000')
+        # binary frames on per symbol topics
+        publisher = TickPublisher(zmqsocket, batchsize=batchsize)
+        self.publisher = publisher
         
         # connect to correct socket 
         self.addr = addr
@@ -53,7 +61,15 @@ class WSClient(object):
             def on_message(self, data):
                 prased = _tryJson(data, raw)
                 on_data(prased)
-                zmqsocket.send_multipart([bytes('IEX', 'utf-8'), bytes(json.dumps(prased), 'utf-8')])
+                if isinstance(prased, str):
+                    prased = _tryJson(prased, False)
+                if isinstance(prased, dict) and 'bidPrice' in prased:
+                    publisher.publish('IEX', prased['symbol'], prased.get('lastUpdated') or 0,
+                                      prased.get('bidPrice'), prased.get('askPrice'),
+                                      prased.get('bidSize'), prased.get('askSize'))
+                else:
+                    # DEEP books have no tick frame, they keep the json messages on the IEX topic
+                    zmqsocket.send_multipart([_LEGACY_TOPIC, bytes(json.dumps(prased), 'utf-8')])
 
         self._Namespace = Namespace
 
@@ -69,7 +85,13 @@ class WSClient(object):
                 subscribe_dict['symbols'] = [t]
                 self.namespace.emit('subscribe', json.dumps(subscribe_dict))
                 print('Subscribe to IEX DEEP {}'.format(t))
-        self.socketIO.wait()
+        if self.publisher.batchsize <= 1:
+            self.socketIO.wait()
+            return None
+        # wake up every interval so quiet symbols do not keep their frames
+        while True:
+            self.socketIO.wait(seconds=self.publisher.interval)
+            self.publisher.flush_expired()
 
 
 if __name__=="__main__":
@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 import pandas as pd
 import numpy as np
 
@@ -11,5 +13,116 @@ def sharpe_ratio(pnlhist,riskless=0):
     return sharpe
 
 
+class PnLStats:
+    """Running statistics of portfolio value updated in O(1) per step.
+
+    Returns are simple returns between consecutive values, mean and
+    variance use Welford's algorithm and match sharpe_ratio on the full
+    history. The state can be saved with snapshot and restored with
+    from_snapshot, so the statistics outlive the pnlhistory list.
+    """
+
+    def __init__(self, periods=252):
+        self.periods = periods
+        self.count = 0 # number of returns
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.downside = 0.0 # sum of squared negative returns
+        self.hits = 0 # number of positive returns
+        self.last = None # last portfolio value
+        self.peak = None
+        self.maxdrawdown = 0.0
+
+    def update(self, value):
+        """Add the portfolio value of a new step."""
+        last, self.last = self.last, value
+        if self.peak is None or value > self.peak:
+            self.peak = value
+        elif self.peak > 0:
+            self.maxdrawdown = max(self.maxdrawdown, (self.peak - value) / self.peak)
+        if last is None or last == 0:
+            return None
+        r = value / last - 1
+        if not np.isfinite(r):
+            return None
+        self.count += 1
+        delta = r - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (r - self.mean)
+        if r < 0:
+            self.downside += r * r
+        elif r > 0:
+            self.hits += 1
+        return None
+
+    def _ratio(self, riskless, deviation):
+        if self.count == 0:
+            return 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (np.float64(self.mean) * self.periods - riskless) / (np.sqrt(np.float64(deviation)) * np.sqrt(self.periods))
+
+    def sharpe(self, riskless=0):
+        return self._ratio(riskless, self.m2 / max(self.count, 1))
+
+    def sortino(self, riskless=0):
+        return self._ratio(riskless, self.downside / max(self.count, 1))
+
+    @property
+    def hitrate(self):
+        return self.hits / self.count if self.count else 0
+
+    def snapshot(self):
+        """State of the statistics as a plain dictionary."""
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_snapshot(cls, state):
+        stats = cls()
+        stats.__dict__.update(state)
+        return stats
+
+
+# volume, price and transact are aligned with the asset index of the Rebalancer
+Fill = namedtuple('Fill', ['volume', 'price', 'transact', 'cash', 'abspos'])
+
+
+class Rebalancer:
+    """Rebalance positions to target holdings on aligned float64 arrays.
+
+    Every array is indexed by the same precomputed asset index. Work
+    buffers are allocated once, so the arrays of the returned Fill are
+    overwritten by the next rebalance and must be copied to be kept.
+    """
+
+    def __init__(self, n_assets):
+        self.positions = np.zeros(n_assets)
+        self.volume = np.zeros(n_assets)
+        self.price = np.zeros(n_assets)
+        self.transact = np.zeros(n_assets)
+        self.exposure = np.zeros(n_assets)
+        self.buy = np.zeros(n_assets, dtype=bool)
 
+    def rebalance(self, target, bid, ask, mid, cash, caplim):
+        """Trade positions to target, buying at ask and selling at bid."""
+        # check asset allocation limit
+        np.abs(target, out=self.exposure)
+        np.multiply(self.exposure, mid, out=self.exposure)
+        abspos = np.nansum(self.exposure) + cash
+        if abspos > caplim:
+            raise ValueError('Portfolio allocation cannot exceed capital limit')
+        np.subtract(target, self.positions, out=self.volume)
+        np.greater(self.volume, 0, out=self.buy)
+        np.copyto(self.price, bid)
+        np.copyto(self.price, ask, where=self.buy)
+        np.multiply(self.price, self.volume, out=self.transact)
+        # check cash must be positive
+        cash = cash - np.nansum(self.transact)
+        if cash < 0:
+            raise ValueError('Cash cannot be negative')
+        np.copyto(self.positions, target)
+        return Fill(self.volume, self.price, self.transact, cash, abspos)
 
+    def value(self, mid, cash):
+        """Mark to market value of positions plus cash."""
+        np.multiply(self.positions, mid, out=self.exposure)
+        return np.nansum(self.exposure) + cash
@@ -0,0 +1,132 @@
+"""Fixed capacity price history backed by NumPy ring buffers."""
+import numpy as np
+import pandas as pd
+
+Fields = ['bid', 'ask', 'bidsize', 'asksize']
+Index = ['time', 'exchange', 'ticker']
+
+
+class RingBuffer:
+    """Timestamped rows of a single (exchange, ticker) with fixed capacity.
+
+    Every row is written twice, at pos and pos + capacity, so the most
+    recent rows always form one contiguous slice that can be returned
+    as a view without copying.
+    """
+
+    def __init__(self, capacity, width=len(Fields)):
+        self.capacity = capacity
+        self.times = np.zeros(2 * capacity, dtype='int64')
+        self.values = np.zeros((2 * capacity, width), dtype='float64')
+        self.pos = 0
+        self.size = 0
+        self.count = 0 # rows appended since creation
+        self.last = None
+
+    def append(self, time, values):
+        """Append one row, returns False if time equals the last row."""
+        if time == self.last:
+            return False
+        pos = self.pos
+        self.times[pos] = self.times[pos + self.capacity] = time
+        self.values[pos] = self.values[pos + self.capacity] = values
+        self.pos = (pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.count += 1
+        self.last = time
+        return True
+
+    def view(self):
+        """Return (times, values) of the buffered rows, oldest first."""
+        end = self.pos + self.capacity
+        start = end - self.size
+        return self.times[start:end], self.values[start:end]
+
+    def __len__(self):
+        return self.size
+
+
+class PriceHistory:
+    """Most recent maxlookup ticks of every (exchange, ticker).
+
+    Appending is O(1) per tick. The MultiIndex DataFrame of the whole
+    history is only built when frame() is called and is cached until the
+    next tick arrives.
+    """
+
+    def __init__(self, maxlookup=1000):
+        self.maxlookup = maxlookup
+        self.buffers = dict()
+        self.marks = dict() # buffer counts at the last checkpoint
+        self._frame = None
+
+    def append(self, ticks):
+        """Append a tick DataFrame with Tick columns."""
+        if ticks.shape[0] == 0:
+            return None
+        times = pd.to_datetime(ticks['time']).to_numpy(dtype='datetime64[ns]').view('int64')
+        values = ticks[Fields].to_numpy(dtype='float64')
+        return self.append_arrays(times, ticks['exchange'].to_numpy(), ticks['ticker'].to_numpy(), values)
+
+    def append_arrays(self, times, exchanges, tickers, values):
+        """Append ticks given as int64 nanosecond times and Fields values."""
+        updated = False
+        for exchange, ticker, t, v in zip(exchanges, tickers, times, values):
+            key = (exchange, ticker)
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = self.buffers[key] = RingBuffer(self.maxlookup)
+            updated = buffer.append(t, v) or updated
+        if updated:
+            self._frame = None
+        return None
+
+    def view(self, exchange, ticker):
+        """Zero-copy (times, values) arrays of a single asset, oldest first.
+
+        values columns follow Fields, times are int64 nanoseconds.
+        """
+        buffer = self.buffers.get((exchange, ticker))
+        if buffer is None:
+            return np.empty(0, dtype='int64'), np.empty((0, len(Fields)), dtype='float64')
+        return buffer.view()
+
+    def frame(self):
+        """History as a DataFrame indexed by (time, exchange, ticker)."""
+        if self._frame is None:
+            self._frame = self._build(dict((key, len(b)) for key, b in self.buffers.items()))
+        return self._frame
+
+    def checkpoint(self):
+        """Rows appended since the previous checkpoint, indexed like frame().
+
+        Rows that already left the buffers are lost, checkpoint at least
+        every maxlookup ticks per asset to keep every row.
+        """
+        rows = dict()
+        for key, buffer in self.buffers.items():
+            rows[key] = min(buffer.count - self.marks.get(key, 0), len(buffer))
+            self.marks[key] = buffer.count
+        return self._build(rows)
+
+    def _build(self, rows):
+        """Frame of the last rows[key] rows of every buffer."""
+        times, values, exchanges, tickers = [], [], [], []
+        for (exchange, ticker), n in rows.items():
+            t, v = self.buffers[(exchange, ticker)].view()
+            t, v = t[len(t) - n:], v[len(v) - n:]
+            times.append(t)
+            values.append(v)
+            exchanges.append(np.full(len(t), exchange, dtype=object))
+            tickers.append(np.full(len(t), ticker, dtype=object))
+        if not times:
+            return pd.DataFrame(columns=Index + Fields).set_index(Index)
+        times = np.concatenate(times)
+        order = np.argsort(times, kind='stable')
+        index = pd.MultiIndex.from_arrays([pd.to_datetime(times[order]),
+                                           np.concatenate(exchanges)[order],
+                                           np.concatenate(tickers)[order]], names=Index)
+        return pd.DataFrame(np.concatenate(values)[order], index=index, columns=Fields)
+
+    def __len__(self):
+        return sum(len(b) for b in self.buffers.values())
@@ -0,0 +1,56 @@
+"""Append-only parquet checkpoints of agent price and holdings history."""
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+TickSchema = None
+if pa is not None:
+    TickSchema = pa.schema([('time', pa.timestamp('ns')), ('exchange', pa.dictionary(pa.int32(), pa.string())),
+                            ('ticker', pa.dictionary(pa.int32(), pa.string())), ('bid', pa.float64()),
+                            ('ask', pa.float64()), ('bidsize', pa.float64()), ('asksize', pa.float64())])
+
+
+class ParquetRecorder:
+    """Write checkpoints as new parquet files, never rewriting old ones.
+
+    Files are partitioned as
+    path/<kind>/agent=<agent>/session=<session>/date=<date>/step_<step>.parquet
+    so a day of one session loads with a single pd.read_parquet of its
+    directory, or of path/<kind> for every session.
+    """
+
+    def __init__(self, path='PedlarRecords', compression='zstd'):
+        if pa is None:
+            raise ImportError('ParquetRecorder requires pyarrow')
+        self.path = path
+        self.compression = compression
+
+    def _write(self, kind, df, agent, session, step, schema=None):
+        if df.shape[0] == 0:
+            return []
+        filenames = []
+        for date, part in df.groupby(df['time'].dt.date, sort=True):
+            folder = os.path.join(self.path, kind, 'agent={}'.format(agent), 'session={}'.format(session), 'date={}'.format(date))
+            os.makedirs(folder, exist_ok=True)
+            filename = os.path.join(folder, 'step_{}.parquet'.format(step))
+            table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+            pq.write_table(table, filename, compression=self.compression)
+            filenames.append(filename)
+        return filenames
+
+    def write_prices(self, ticks, agent, session, step):
+        """Ticks indexed by (time, exchange, ticker), e.g. PriceHistory.checkpoint()."""
+        return self._write('prices', ticks.reset_index(), agent, session, step, TickSchema)
+
+    def write_holdings(self, holdings, agent, session, step, time_format="%Y_%m_%d_%H_%M_%S"):
+        """Holdings rows indexed by time with one volume column per asset."""
+        df = holdings.copy()
+        df.columns = [c if isinstance(c, str) else ''.join(c) for c in df.columns]
+        df.insert(0, 'time', pd.to_datetime(df.index, format=time_format))
+        return self._write('holdings', df.reset_index(drop=True), agent, session, step)
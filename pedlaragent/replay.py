@@ -0,0 +1,158 @@
+"""Replay recorded ticks for offline backtests."""
+import copy
+import glob
+import os
+
+import pandas as pd
+import numpy as np
+
+Tick = ['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize']
+Fields = Tick[3:]
+
+
+def read_ticks(source):
+    """Read recorded ticks into a DataFrame with Tick columns.
+
+    source is a DataFrame, a csv or parquet file name, a parquet dataset
+    directory such as 'PedlarRecords/prices', a glob pattern such as
+    'Historical_Price_*.csv' or a list of those.
+    """
+    if isinstance(source, pd.DataFrame):
+        frames = [source.reset_index() if 'time' not in source.columns else source]
+    else:
+        if isinstance(source, str):
+            source = sorted(glob.glob(source)) or [source]
+        frames = []
+        for filename in source:
+            if filename.endswith('.parquet') or os.path.isdir(filename):
+                df = pd.read_parquet(filename)
+            else:
+                df = pd.read_csv(filename)
+            frames.append(df.reset_index() if 'time' not in df.columns else df)
+    ticks = pd.concat(frames, axis=0, ignore_index=True)[Tick]
+    ticks['time'] = pd.to_datetime(ticks['time'])
+    # files saved by consecutive save_record calls overlap
+    ticks = ticks.drop_duplicates(subset=['time', 'exchange', 'ticker'], keep='first')
+    ticks = ticks.sort_values('time', kind='mergesort').reset_index(drop=True)
+    return ticks
+
+
+class TickReplay:
+    """Stream recorded ticks one step at a time without sleeping.
+
+    Each step returns every tick sharing a timestamp, or every tick in the
+    same freq bucket (e.g. '5s') to mimic the polling interval of live runs.
+    Ticks are kept as arrays, next_arrays hands out views of them and the
+    DataFrame of next_tick and ticks is only built when asked for.
+    """
+
+    def __init__(self, source, freq=None):
+        ticks = read_ticks(source)
+        self._load(ticks['time'].to_numpy(dtype='datetime64[ns]').view('int64'), ticks['exchange'].to_numpy(dtype=object),
+                   ticks['ticker'].to_numpy(dtype=object), ticks[Fields].to_numpy(dtype='float64'), freq)
+        self._ticks = ticks
+
+    @classmethod
+    def from_arrays(cls, times, exchanges, tickers, values, freq=None):
+        """Replay ticks already sorted by time without copying them.
+
+        times are int64 nanoseconds and values columns follow Fields.
+        """
+        replay = cls.__new__(cls)
+        replay._load(times, exchanges, tickers, values, freq)
+        replay._ticks = None
+        return replay
+
+    def _load(self, times, exchanges, tickers, values, freq):
+        self.times = times
+        self.exchanges = exchanges
+        self.tickers = tickers
+        self.values = values
+        if freq is not None:
+            keys = pd.DatetimeIndex(times.view('datetime64[ns]')).floor(freq).to_numpy(dtype='datetime64[ns]').view('int64')
+        else:
+            keys = times
+        if len(keys):
+            self.bounds = np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(keys)]])
+        else:
+            # no ticks, no steps
+            self.bounds = np.zeros(1, dtype=np.int64)
+        self.steptimes = times[self.bounds[1:] - 1]
+        self.nsteps = len(self.bounds) - 1
+        self.step = 0
+
+    def fork(self):
+        """Replay of the same ticks from the first step, the arrays are shared."""
+        replay = copy.copy(self)
+        replay.step = 0
+        return replay
+
+    @property
+    def ticks(self):
+        """All ticks as a DataFrame with Tick columns."""
+        if self._ticks is None:
+            self._ticks = self._frame(0, len(self.times))
+        return self._ticks
+
+    def _frame(self, start, end):
+        df = pd.DataFrame(self.values[start:end], columns=Fields)
+        df.insert(0, 'ticker', self.tickers[start:end])
+        df.insert(0, 'exchange', self.exchanges[start:end])
+        df.insert(0, 'time', self.times[start:end].view('datetime64[ns]'))
+        return df
+
+    @classmethod
+    def from_arctic(cls, store, arcticcollectionname, tickers, freq=None, start=None, end=None):
+        """Replay ticks stored in arctic, one symbol per ticker."""
+        from .datafeed import arctic2df
+        frames = []
+        for ticker in tickers:
+            df = arctic2df(store, arcticcollectionname, ticker, start, end)
+            if 'time' not in df.columns and df.index.name == 'date':
+                # chunk stores index rows by date
+                df = df.rename_axis('time')
+            frames.append(df)
+        return cls(pd.concat(frames, axis=0), freq)
+
+    @classmethod
+    def from_archive(cls, path, symbols=None, start=None, end=None, freq=None):
+        """Replay a time range of a TickArchive."""
+        from .tickarchive import TickArchive
+        return cls(TickArchive(path).ticks(symbols, start, end), freq)
+
+    @property
+    def exhausted(self):
+        return self.step >= self.nsteps
+
+    @property
+    def time(self):
+        """Timestamp of the last replayed step."""
+        if self.step == 0:
+            return None
+        return pd.Timestamp(self.steptimes[self.step - 1])
+
+    def next_tick(self):
+        """Ticks of the next step, an empty frame once exhausted."""
+        if self.exhausted:
+            return self._frame(0, 0)
+        start, end = self.bounds[self.step], self.bounds[self.step + 1]
+        self.step += 1
+        return self._frame(start, end)
+
+    def next_arrays(self):
+        """(times, exchanges, tickers, values) views of the next step."""
+        if self.exhausted:
+            start = end = 0
+        else:
+            start, end = self.bounds[self.step], self.bounds[self.step + 1]
+            self.step += 1
+        return self.times[start:end], self.exchanges[start:end], self.tickers[start:end], self.values[start:end]
+
+    def last_tick(self):
+        """Ticks of the last replayed step as a DataFrame."""
+        if self.step == 0:
+            return self._frame(0, 0)
+        return self._frame(self.bounds[self.step - 1], self.bounds[self.step])
+
+    def __len__(self):
+        return self.nsteps
@@ -0,0 +1,160 @@
+"""Local tick archive of fixed-width records in memory-mapped files.
+
+Every (exchange, ticker) has a .ticks file of ArchiveRecord rows in time
+order and a small .idx file holding the time of every stride-th row.
+Reading a time range searches the index first and then a single stride
+of the memory map, so only the pages of the requested range are touched.
+"""
+import os
+from urllib.parse import quote, unquote
+
+import pandas as pd
+import numpy as np
+
+from .replay import Tick
+
+# time is nanoseconds since epoch
+ArchiveRecord = np.dtype([('time', '<i8'), ('bid', '<f8'), ('ask', '<f8'), ('bidsize', '<f8'), ('asksize', '<f8')])
+
+
+def _nanoseconds(t):
+    return pd.Timestamp(t).value
+
+
+class TickArchive:
+    """Append-only tick archive under path, e.g.
+
+    archive = TickArchive('TickArchive')
+    archive.append(read_ticks('Historical_Price_*.csv'))
+    ticks = archive.ticks([('IEX', 'SPY')], start='2018-06-04', end='2018-06-09')
+    """
+
+    def __init__(self, path='TickArchive', stride=4096):
+        self.path = path
+        self.stride = stride
+        self._maps = dict()
+
+    def _filename(self, exchange, ticker, ext):
+        return os.path.join(self.path, quote(exchange, safe=''), quote(ticker, safe='') + ext)
+
+    def symbols(self):
+        """Archived (exchange, ticker) pairs."""
+        pairs = []
+        if not os.path.isdir(self.path):
+            return pairs
+        for exchange in sorted(os.listdir(self.path)):
+            folder = os.path.join(self.path, exchange)
+            for name in sorted(os.listdir(folder)):
+                if name.endswith('.ticks'):
+                    pairs.append((unquote(exchange), unquote(name[:-len('.ticks')])))
+        return pairs
+
+    def _records(self, exchange, ticker):
+        key = (exchange, ticker)
+        if key not in self._maps:
+            filename = self._filename(exchange, ticker, '.ticks')
+            if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+                records = np.empty(0, dtype=ArchiveRecord)
+            else:
+                records = np.memmap(filename, dtype=ArchiveRecord, mode='r')
+            index = np.fromfile(self._filename(exchange, ticker, '.idx'), dtype='<i8') if len(records) else np.empty(0, dtype='<i8')
+            self._maps[key] = (records, index)
+        return self._maps[key]
+
+    def append(self, ticks):
+        """Append a tick DataFrame with Tick columns.
+
+        Ticks of a symbol must not be older than the ones already archived.
+        """
+        ticks = ticks.reset_index() if 'time' not in ticks.columns else ticks
+        # check every symbol before writing so a rejected frame leaves no partial append
+        pending = []
+        for (exchange, ticker), df in ticks.groupby(['exchange', 'ticker'], sort=False):
+            records = np.empty(len(df), dtype=ArchiveRecord)
+            records['time'] = pd.to_datetime(df['time']).to_numpy(dtype='datetime64[ns]').view('int64')
+            for col in ['bid', 'ask', 'bidsize', 'asksize']:
+                records[col] = df[col].to_numpy(dtype='float64')
+            records = records[np.argsort(records['time'], kind='stable')]
+            old, _ = self._records(exchange, ticker)
+            if len(old) and records['time'][0] < old['time'][-1]:
+                raise ValueError('Ticks of {}:{} older than the archive'.format(exchange, ticker))
+            pending.append((exchange, ticker, records, len(old)))
+        for exchange, ticker, records, n in pending:
+            self._maps.pop((exchange, ticker), None)
+            os.makedirs(os.path.dirname(self._filename(exchange, ticker, '.ticks')), exist_ok=True)
+            with open(self._filename(exchange, ticker, '.ticks'), 'ab') as f:
+                f.write(records.tobytes())
+            # index rows are the global positions that are multiples of stride
+            first = -(-n // self.stride) * self.stride
+            with open(self._filename(exchange, ticker, '.idx'), 'ab') as f:
+                f.write(records['time'][first - n::self.stride].astype('<i8').tobytes())
+        return None
+
+    def _find(self, records, index, t, side):
+        b = np.searchsorted(index, t, side)
+        lo = max(b - 1, 0) * self.stride
+        hi = min(b * self.stride, len(records))
+        return lo + int(np.searchsorted(records['time'][lo:hi], t, side))
+
+    def read(self, exchange, ticker, start=None, end=None):
+        """Zero-copy ArchiveRecord rows with start <= time <= end."""
+        records, index = self._records(exchange, ticker)
+        lo = 0 if start is None else self._find(records, index, _nanoseconds(start), 'left')
+        hi = len(records) if end is None else self._find(records, index, _nanoseconds(end), 'right')
+        return records[lo:max(lo, hi)]
+
+    def frame(self, exchange, ticker, start=None, end=None):
+        """Tick DataFrame of a single symbol."""
+        return _to_frame([(exchange, ticker, self.read(exchange, ticker, start, end))])
+
+    def iterate(self, symbols=None, start=None, end=None, chunksize=100000):
+        """Tick DataFrames of several symbols merged in time order.
+
+        Each chunk holds at most chunksize ticks per symbol, ties keep the
+        order of symbols.
+        """
+        if symbols is None:
+            symbols = self.symbols()
+        cursors = [(exchange, ticker, self.read(exchange, ticker, start, end)) for exchange, ticker in symbols]
+        pos = [0] * len(cursors)
+        while True:
+            active = [i for i, c in enumerate(cursors) if pos[i] < len(c[2])]
+            if not active:
+                break
+            # the symbol with the earliest chunk end is read in full, the others up to that time
+            boundary = min(cursors[i][2]['time'][min(pos[i] + chunksize, len(cursors[i][2])) - 1] for i in active)
+            parts = []
+            for i in active:
+                exchange, ticker, records = cursors[i]
+                chunk = records[pos[i]:pos[i] + chunksize]
+                n = int(np.searchsorted(chunk['time'], boundary, 'right'))
+                parts.append((exchange, ticker, chunk[:n]))
+                pos[i] += n
+            yield _to_frame(parts)
+
+    def ticks(self, symbols=None, start=None, end=None, chunksize=100000):
+        """Single merged tick DataFrame, see iterate."""
+        frames = list(self.iterate(symbols, start, end, chunksize))
+        if not frames:
+            return _to_frame([])
+        return pd.concat(frames, axis=0, ignore_index=True)
+
+
+def _to_frame(parts):
+    """Tick DataFrame of [(exchange, ticker, records)] sorted by time."""
+    if not parts:
+        return pd.DataFrame(columns=Tick)
+    records = np.concatenate([p[2] for p in parts])
+    exchanges = np.concatenate([np.full(len(p[2]), p[0], dtype=object) for p in parts])
+    tickers = np.concatenate([np.full(len(p[2]), p[1], dtype=object) for p in parts])
+    order = np.argsort(records['time'], kind='stable')
+    records = records[order]
+    return pd.DataFrame({
+        'time': records['time'].view('datetime64[ns]'),
+        'exchange': exchanges[order],
+        'ticker': tickers[order],
+        'bid': records['bid'],
+        'ask': records['ask'],
+        'bidsize': records['bidsize'],
+        'asksize': records['asksize'],
+    }, columns=Tick)
@@ -0,0 +1,87 @@
+"""Binary tick frames for the ZMQ ticker.
+
+Every message is [topic, payload]. The topic is 'EXCHANGE:TICKER|' so
+subscribers filter symbols at the socket, and the payload is one or more
+TickFrame records of the same symbol.
+"""
+import time
+import zlib
+
+import numpy as np
+
+# time is milliseconds since epoch, symbol is symbol_id of the topic
+TickFrame = np.dtype([('symbol', '<u4'), ('time', '<i8'), ('bid', '<f8'), ('ask', '<f8'),
+                      ('bidsize', '<f8'), ('asksize', '<f8')])
+
+
+def topic(exchange, ticker):
+    """Topic of a symbol, terminated so SPY does not match SPYG."""
+    return '{}:{}|'.format(exchange, ticker).encode()
+
+
+def symbol_id(exchange, ticker):
+    """Stable id of a symbol, the same in every process."""
+    return zlib.crc32(topic(exchange, ticker))
+
+
+def subscribe(socket, universe=None):
+    """Subscribe a SUB socket to (exchange, ticker) pairs, or everything."""
+    import zmq
+    if universe is None:
+        socket.setsockopt(zmq.SUBSCRIBE, bytes())
+    else:
+        for exchange, ticker in universe:
+            socket.setsockopt(zmq.SUBSCRIBE, topic(exchange, ticker))
+
+
+def decode(message):
+    """Return (exchange, ticker, frames) of a [topic, payload] message."""
+    exchange, ticker = message[0].decode()[:-1].split(':', 1)
+    frames = np.frombuffer(message[1], dtype=TickFrame)
+    return exchange, ticker, frames
+
+
+class TickPublisher:
+    """Publish ticks as binary frames on a PUB socket.
+
+    With batchsize > 1 frames of a symbol are held back until batchsize
+    of them are queued or interval seconds passed since the first one.
+    Every publish sends the symbols whose interval passed, a publisher
+    that may go quiet should also call flush_expired periodically.
+    """
+
+    def __init__(self, socket, batchsize=1, interval=0.05):
+        self.socket = socket
+        self.batchsize = batchsize
+        self.interval = interval
+        self.pending = dict() # topic -> (first queued time, list of frames)
+
+    def publish(self, exchange, ticker, time_ms, bid, ask, bidsize, asksize):
+        key = topic(exchange, ticker)
+        frame = np.array([(symbol_id(exchange, ticker), time_ms, bid, ask, bidsize, asksize)], dtype=TickFrame)
+        if self.batchsize <= 1:
+            self.socket.send_multipart([key, frame.tobytes()])
+            return None
+        now = time.monotonic()
+        first, frames = self.pending.setdefault(key, (now, []))
+        frames.append(frame)
+        if len(frames) >= self.batchsize:
+            self._send(key)
+        self.flush_expired(now)
+        return None
+
+    def flush_expired(self, now=None):
+        """Send the symbols whose first held back frame is interval seconds old."""
+        if now is None:
+            now = time.monotonic()
+        for key in [k for k, (first, _) in self.pending.items() if now - first >= self.interval]:
+            self._send(key)
+
+    def _send(self, key):
+        _, frames = self.pending.pop(key)
+        self.socket.send_multipart([key, np.concatenate(frames).tobytes()])
+
+    def flush(self):
+        """Send every held back frame."""
+        for key in list(self.pending):
+            self._send(key)
@@ -9,11 +9,9 @@ import requests
 import pandas as pd
 import numpy as np
 pd.set_option('expand_frame_repr', False)
-pd.set_option('max_columns', 12)
+pd.set_option('display.max_columns', 12)
 
 from datetime import timedelta
-from pandas.io.common import urlencode
-from io import StringIO 
 
 
 SYMBOLS_NOT_AUTH = ['EUR/USD', 'USD/JPY', 'GBP/USD', 'EUR/GBP', 'USD/CHF', 
@@ -24,19 +22,16 @@ SYMBOLS_ALL = ['EUR/USD', 'USD/JPY', 'GBP/USD', 'EUR/GBP', 'USD/CHF', 'AUD/NZD',
     'AUD/USD', 'GBP/JPY', 'AUD/CAD', 'AUD/CHF', 'AUD/JPY', 'EUR/NOK', 'EUR/NZD', 
     'GBP/CAD', 'GBP/CHF', 'NZD/JPY', 'NZD/USD', 'USD/NOK', 'USD/SEK']
 
+TRUEFX_URL = "http://webrates.truefx.com/rates/connect.html"
 
 
-def _send_request(session, params):
-    base_url = "http://webrates.truefx.com/rates"
-    endpoint = "/connect.html"
-    url = base_url + endpoint
-    s_url = url + '?' + urlencode(params)
+def _send_request(session, params, url=TRUEFX_URL):
     response = session.get(url, params=params)
     return(response)
 
 
 def _connect(session, username, password, lst_symbols, qualifier, \
-        api_format, snapshot):
+        api_format, snapshot, url=TRUEFX_URL):
     s = 'y' if snapshot else 'n'
     params = {
         'u': username,
@@ -46,7 +41,7 @@ def _connect(session, username, password, lst_symbols, qualifier, \
         'f': api_format,
         's': s
     }
-    response = _send_request(session, params)
+    response = _send_request(session, params, url)
     if response.status_code != 200:
         raise(Exception("Can't connect"))
     session_data = response.text
@@ -54,19 +49,19 @@ def _connect(session, username, password, lst_symbols, qualifier, \
     return(session_data)
 
 
-def _disconnect(session, session_data):
+def _disconnect(session, session_data, url=TRUEFX_URL):
     params = {
         'di': session_data,
     }
-    response = _send_request(session, params)
+    response = _send_request(session, params, url)
     return(response)
 
 
-def _query_auth_send(session, session_data):
+def _query_auth_send(session, session_data, url=TRUEFX_URL):
     params = {
         'id': session_data,
     }
-    response = _send_request(session, params)
+    response = _send_request(session, params, url)
     return(response)
 
 def _query_not_auth(session, lst_symbols, api_format, snapshot):
@@ -110,21 +105,68 @@ def _get_session(expire_after, cache_name='cache'):
     return session
 
 def _parse_data(data):
-    data_io = StringIO(data)
-    df = pd.read_csv(data_io, header=None, \
-    names=['ticker', 'time', 'bid', 'Bid_point', \
-            'ask', 'Ask_point', 'High', 'Low', 'Open']    )
-
-    df['time'] = pd.to_datetime(df['time'], unit='ms')
-    df['Bid_point'] = df['Bid_point'].map(str).str.zfill(3)
-    df['Ask_point'] = df['Ask_point'].map(str).str.zfill(3)
-    df['bid'] = (df['bid'].map(str).str.ljust(4, '0').str.slice(stop=4) + df['Bid_point'].map(str)).map(np.float64)
-    df['ask'] = (df['ask'].map(str).str.ljust(4, '0').str.slice(stop=4) + df['Ask_point'].map(str)).map(np.float64)
-    df['exchange'] = 'TrueFX'
-    df['bidsize'] = 100
-    df['asksize'] = 100
+    """Parse a TrueFX csv payload with arithmetic on its bytes.
+
+    Each quote is split in a big figure, whose first 4 characters are
+    kept, and points, e.g. 1.09,912 is 1.09912 and 108.,123 is 108.123.
+    Digits are accumulated per field into integer mantissas so prices
+    are exactly float(bigfigure + points).
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    # blank lines, e.g. a trailing one before the end of the payload, hold no quote
+    data = b'\n'.join(line for line in data.replace(b'\r', b'').split(b'\n') if line.strip())
     columns = ['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize']
-    return df[columns]
+    if not data:
+        return pd.DataFrame(columns=columns)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    sep = (buf == ord(',')) | (buf == ord('\n'))
+    starts = np.concatenate([[0], np.flatnonzero(sep) + 1])
+    nfields = len(starts)
+    if nfields % 9:
+        raise ValueError('TrueFX payload must have 9 fields per row')
+    field = np.cumsum(sep)
+    pos = np.arange(len(buf)) - starts[field]
+    col = field % 9
+    # big figures are truncated to their first 4 characters
+    keep = ~sep & ~(((col == 2) | (col == 4)) & (pos >= 4))
+    isdigit = keep & (buf >= ord('0')) & (buf <= ord('9'))
+    isdot = keep & (buf == ord('.'))
+    length = np.bincount(field[keep], minlength=nfields)
+    ndigits = np.bincount(field[isdigit], minlength=nfields)
+    hasdot = np.bincount(field[isdot], minlength=nfields) > 0
+    # rank of every digit within its field and whether it is after the dot
+    digitcount = np.cumsum(isdigit)
+    dotcount = np.cumsum(isdot)
+    rank = digitcount - 1 - (digitcount - isdigit)[starts][field]
+    afterdot = dotcount - (dotcount - isdot)[starts][field] > 0
+    exponent = (ndigits[field] - 1 - rank)[isdigit]
+    mantissa = np.bincount(field[isdigit], weights=(buf[isdigit] - ord('0')) * 10.0 ** exponent, minlength=nfields)
+    decimals = np.bincount(field[isdigit & afterdot], minlength=nfields)
+
+    mantissa = mantissa.reshape(-1, 9)
+    rows = mantissa.shape[0]
+
+    def price(figure, point):
+        fields = np.arange(rows) * 9
+        # ljust(4, '0') on the big figure then zfill(3) on the points
+        pad = np.clip(4 - length[fields + figure], 0, None)
+        figuredecimals = decimals[fields + figure] + np.where(hasdot[fields + figure], pad, 0)
+        pointdigits = np.maximum(ndigits[fields + point], 3)
+        numerator = mantissa[:, figure] * 10.0 ** (pad + pointdigits) + mantissa[:, point]
+        return numerator / 10.0 ** (figuredecimals + pointdigits)
+
+    tickers = [line.split(b',', 1)[0].decode() for line in data.split(b'\n')]
+    df = pd.DataFrame({
+        'time': (mantissa[:, 1].astype('int64') * 1000000).view('datetime64[ns]'),
+        'exchange': 'TrueFX',
+        'ticker': tickers,
+        'bid': price(2, 3),
+        'ask': price(4, 5),
+        'bidsize': 100,
+        'asksize': 100,
+    }, columns=columns)
+    return df
     
 def _query(symbols='', qualifier='default', api_format='csv', snapshot=True, \
         username='', password='', force_unregistered=False, flag_parse_data=True, session=None):    
@@ -165,6 +207,85 @@ def read_tick(session,session_data,flag_parse_data,authrozied):
     else:
         return data
 
+class TrueFXStream:
+    """Incremental TrueFX session merged into a last quote table.
+
+    Registered users get a non-snapshot session, so TrueFX only sends
+    the pairs that changed since the previous request. Unregistered
+    queries are prepared once and re-sent on the same connection. Either
+    way read merges the reply into the last quote table and returns only
+    the pairs whose quote changed.
+    """
+
+    def __init__(self, symbols='', username='', password='', force_unregistered=False, session=None, url=TRUEFX_URL):
+        username, password = _init_credentials(username, password)
+        self.session = _init_session(session)
+        self.url = url
+        self.authorized = _is_registered(username, password) and not force_unregistered
+        symbols = [s.upper() for s in symbols if s]
+        if not symbols:
+            symbols = SYMBOLS_ALL if self.authorized else SYMBOLS_NOT_AUTH
+        self.symbols = symbols
+        if self.authorized:
+            self.session_data = _connect(self.session, username, password, symbols, 'default', 'csv', False, url)
+            if 'not authorized' in self.session_data:
+                raise(Exception('not authorized'))
+            params = {'id': self.session_data}
+        else:
+            self.session_data = None
+            params = {'c': ','.join(symbols), 'f': 'csv', 's': 'y'}
+        self.request = self.session.prepare_request(requests.Request('GET', url, params=params))
+        # last quote table, one row per pair: time in ms, bid, ask
+        self.index = dict()
+        self.tickers = []
+        self.table = np.full((0, 3), np.nan)
+
+    def _rows(self, tickers):
+        idx = np.empty(len(tickers), dtype=int)
+        for i, t in enumerate(tickers):
+            j = self.index.get(t)
+            if j is None:
+                j = self.index[t] = len(self.tickers)
+                self.tickers.append(t)
+            idx[i] = j
+        if len(self.tickers) > self.table.shape[0]:
+            grown = np.full((len(self.tickers), 3), np.nan)
+            grown[:self.table.shape[0]] = self.table
+            self.table = grown
+        return idx
+
+    def read(self):
+        """Quotes of the pairs that changed since the last read."""
+        response = self.session.send(self.request)
+        if response.status_code != 200:
+            raise(Exception("Can't connect"))
+        df = _parse_data(response.content)
+        if df.shape[0] == 0:
+            return df
+        idx = self._rows(df['ticker'].tolist())
+        quotes = np.column_stack([df['time'].to_numpy(dtype='datetime64[ms]').view('int64'),
+                                  df['bid'].to_numpy(), df['ask'].to_numpy()])
+        changed = (quotes != self.table[idx]).any(axis=1)
+        self.table[idx[changed]] = quotes[changed]
+        return df[changed].reset_index(drop=True)
+
+    def quotes(self):
+        """Last quote of every pair seen so far."""
+        return pd.DataFrame({
+            'time': (self.table[:, 0].astype('int64') * 1000000).view('datetime64[ns]'),
+            'exchange': 'TrueFX',
+            'ticker': self.tickers,
+            'bid': self.table[:, 1],
+            'ask': self.table[:, 2],
+            'bidsize': 100,
+            'asksize': 100,
+        }, columns=['time', 'exchange', 'ticker', 'bid', 'ask', 'bidsize', 'asksize'])
+
+    def close(self):
+        if self.session_data is not None:
+            _disconnect(self.session, self.session_data, self.url)
+            self.session_data = None
+
 def config(symbols='', 
           username='', password='', 
           force_unregistered=False, expire_after='-1', snapshot=True, api_format = 'csv',flag_parse_data = True):
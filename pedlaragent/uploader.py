@@ -0,0 +1,124 @@
+"""Background uploader of portfolio snapshots to the pedlar server."""
+import logging
+import queue
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class Uploader:
+    """Queue portfolio snapshots and post them in batches from a thread.
+
+    Snapshots are sent to /portfolio/<tradesession>/bulk over a pooled
+    requests.Session owned by the upload thread, synchronous posts use
+    their own session since sessions are not thread safe. The queue is bounded: when the server falls behind
+    put waits at most timeout seconds and then drops the oldest snapshot,
+    so the trading loop never waits on the network. Every request gives up
+    after requesttimeout seconds and flush waits at most flushtimeout.
+    """
+
+    def __init__(self, endpoint, maxsize=1000, batchsize=100, interval=1, timeout=0.1, retries=2,
+                 requesttimeout=5, flushtimeout=30):
+        self.endpoint = endpoint
+        self.batchsize = batchsize
+        self.interval = interval # seconds to wait for a batch to fill up
+        self.timeout = timeout
+        self.requesttimeout = requesttimeout
+        self.flushtimeout = flushtimeout
+        self.retries = retries
+        self.dropped = 0
+        self.session = requests.Session() # upload thread only
+        self.postsession = requests.Session()
+        self.queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name='pedlar-uploader', daemon=True)
+        self._thread.start()
+
+    def put(self, snapshot):
+        """Queue a portfolio snapshot, it must contain its tradesession."""
+        try:
+            self.queue.put(snapshot, timeout=self.timeout)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+                logger.warning("Upload queue full, dropped %s snapshots so far.", self.dropped)
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(snapshot)
+
+    def post(self, path, payload):
+        """Synchronous post, returns the json reply."""
+        return self._post(self.postsession, path, payload)
+
+    def _post(self, session, path, payload):
+        r = session.post(self.endpoint+path, json=payload, timeout=self.requesttimeout)
+        r.raise_for_status()
+        return r.json()
+
+    def flush(self, timeout=None):
+        """Wait until every queued snapshot has been sent, or timeout seconds.
+
+        timeout defaults to flushtimeout, returns False if snapshots are left.
+        """
+        deadline = time.monotonic() + (self.flushtimeout if timeout is None else timeout)
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("Flush timed out with %s snapshots queued.", self.queue.unfinished_tasks)
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Send the queued snapshots and stop the upload thread."""
+        self.flush(timeout)
+        try:
+            self.queue.put(None, timeout=self.timeout)
+        except queue.Full:
+            logger.warning("Upload queue full, upload thread left running.")
+        self._thread.join(self.requesttimeout)
+        self.session.close()
+        self.postsession.close()
+
+    def _next_batch(self):
+        """Wait for up to batchsize snapshots, None marks the end."""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batchsize and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, batch):
+        sessions = dict()
+        for snapshot in batch:
+            sessions.setdefault(snapshot['tradesession'], []).append(snapshot)
+        for tradesession, snapshots in sessions.items():
+            for attempt in range(self.retries + 1):
+                try:
+                    self._post(self.session, "/portfolio/{}/bulk".format(tradesession), snapshots)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        logger.error("Failed to upload %s snapshots: %s", len(snapshots), str(e))
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = self._next_batch()
+            done = batch[-1] is None
+            try:
+                self._send([snapshot for snapshot in batch if snapshot is not None])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
@@ -1,12 +1,28 @@
 from flask import Flask, render_template, request, redirect, url_for, jsonify  # For flask implementation
 from pymongo import MongoClient
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pedlaragent.counter import SessionCounter
 
 app = Flask(__name__)
 
 client = MongoClient("localhost") #host uri
 db = client['Pedlar'] #Select the database
 
+def maxid(collection, field):
+    """Largest numeric field of a collection, 0 when it is empty."""
+    doc = collection.find_one({field: {'$type': 'number'}}, sort=[(field, -1)])
+    return doc[field] if doc is not None else 0
+
+# Atomic id counters, seeded on first use with the largest id created before
+# the counters existed so no existing id is handed out again
+usercounter = SessionCounter(db['Counter'], {'_id': 'Users'},
+                             seedfunc=lambda: maxid(db['Users'], 'user_id'))
+backtestcounter = SessionCounter(db['Counter'], {'_id': 'Backtests'},
+                                 seedfunc=lambda: maxid(db['Backtests'], 'backtest_id'))
+
 # create new backtest record 
 
 @app.route("/user", methods=['POST'])
@@ -16,15 +32,13 @@ def user_record():
     agent = req_data.get('agent', 'sample')
     # check if exist in Mongo 
     usertable = db['Users']
-    existing_user_no = db['Users'].count()
-    new_user_id = existing_user_no + 1
     targetuser = usertable.find_one({'user_id':user})
     # create new tradesession id
     backtest_table = db['Backtests']
-    existing_backtest_no = db['Backtests'].count()
-    tradesessionid = existing_backtest_no + 1
+    tradesessionid = backtestcounter.allocate()
     if targetuser is None:
         exist = False
+        new_user_id = usercounter.allocate()
         usertable.insert_one({'user_id': new_user_id})
         backtest_table.insert_one({'user_id':new_user_id, 'agent':agent, 'backtest_id':tradesessionid})
         return jsonify(username=new_user_id, exist=exist, tradesession=tradesessionid)
@@ -1,11 +1,16 @@
 """pedlarweb entry point."""
 
 import datetime 
+import logging
+import numpy as np
+import threading
+import time
 import pandas as pd 
 import requests 
 
 # Setting up multiple apps
 from dash import Dash
+import dash
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from flask import Flask, render_template, redirect, url_for, request, jsonify
 from werkzeug.serving import run_simple
@@ -25,13 +30,32 @@ sys.path.append(os.path.dirname(sys.path[0]))
 
 
 import pedlaragent.iex 
+from pedlaragent.counter import SessionCounter
 
 
 
 # database
 # TO-DO push password to env var 
 import pymongo 
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
 
+# One pooled client per process, connect=False defers connecting until
+# first use so the client is safe to create before gunicorn forks workers
+password = os.environ.get('algosocdbpw', 'algosocadmin')
+client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password), connect=False)
+db = client['Pedlar_dev']
+
+# Portfolio snapshots of every trade session, aged out after algosocportfoliodays days
+portfolio_name = 'Portfolio'
+portfolio_ttl = int(float(os.environ.get('algosocportfoliodays', 30)) * 86400)
+portfolio_ready = False
+
+# Catalog of trade sessions, one document per session
+sessions = db['Sessions']
+sessions_indexed = False
+
+# Trade session ids, each worker reserves algosocidblock ids per round trip
+sessioncounter = SessionCounter(db['Counter'], blocksize=int(os.environ.get('algosocidblock', 1)))
 
 
 # Setting up flask server 
@@ -48,17 +72,182 @@ dash_app1 = Dash(__name__, server = server, url_base_pathname='/leaderboard/', e
 dash_app4 = Dash(__name__, server = server, url_base_pathname='/pnl/', external_stylesheets=external_stylesheets )
 
 # mongo functions 
-def mongo2df(client,dbname,collectionname):
-    
-    db = client.get_database(dbname)
-    df = pd.DataFrame(list(db[collectionname].find({})))
+def session_key(tradesessionid):
+    # trade session ids are ints, urls and dropdown values carry them as strings
     try:
-        df.drop(['_id'], axis=1,inplace=True)
-        df.drop_duplicates(keep='last', inplace=True)
-    except:
-        print('Record not found',collectionname)
-    client.close()
-    return df 
+        return int(tradesessionid)
+    except (TypeError, ValueError):
+        return tradesessionid
+
+def portfolio_snapshots():
+    # time series collection bucketed by tradesession, a plain collection
+    # with the same indexes on servers older than mongodb 5.0
+    global portfolio_ready
+    if not portfolio_ready:
+        try:
+            db.create_collection(portfolio_name, expireAfterSeconds=portfolio_ttl,
+                                 timeseries={'timeField': 'timestamp', 'metaField': 'tradesession', 'granularity': 'seconds'})
+        except CollectionInvalid:
+            pass # created by another worker
+        except OperationFailure:
+            db[portfolio_name].create_index('timestamp', expireAfterSeconds=portfolio_ttl)
+        db[portfolio_name].create_index([('tradesession', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
+        portfolio_ready = True
+    return db[portfolio_name]
+
+def portfolio_documents(snapshots, tradesessionid):
+    # the agent sends time as %Y_%m_%d_%H_%M_%S, timestamp is the date the collection is keyed on
+    docs = []
+    for snapshot in snapshots:
+        doc = dict(snapshot)
+        doc['tradesession'] = session_key(doc.get('tradesession', tradesessionid))
+        try:
+            doc['timestamp'] = datetime.datetime.strptime(doc['time'], "%Y_%m_%d_%H_%M_%S")
+        except (KeyError, TypeError, ValueError):
+            doc['timestamp'] = datetime.datetime.utcnow()
+        docs.append(doc)
+    return docs
+
+def sessions_catalog():
+    # indexes are created on first use, connect=False defers connecting until then
+    global sessions_indexed
+    if not sessions_indexed:
+        sessions.create_index('backtest_id', unique=True)
+        sessions.create_index([('agent', pymongo.ASCENDING), ('backtest_id', pymongo.DESCENDING)])
+        sessions.create_index([('user_id', pymongo.ASCENDING), ('backtest_id', pymongo.DESCENDING)])
+        sessions_indexed = True
+    return sessions
+
+def list_sessions(agent=None, user=None, before=None, limit=50):
+    # newest sessions first, before is the last backtest_id of the previous page
+    query = {}
+    if agent:
+        query['agent'] = agent
+    if user:
+        query['user_id'] = user
+    if before is not None:
+        query['backtest_id'] = {'$lt': before}
+    return list(sessions_catalog().find(query, {'_id': 0}).sort('backtest_id', pymongo.DESCENDING).limit(limit))
+
+def lttb(x, y, points):
+    # largest triangle three buckets, indices of the points that keep the shape of the line
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    keep = [0]
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        # average of the next bucket, the last point for the last bucket
+        nstart, nend = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        ax, ay = x[nstart:nend].mean(), y[nstart:nend].mean()
+        px, py = x[keep[-1]], y[keep[-1]]
+        area = np.abs((px - ax) * (y[start:end] - py) - (px - x[start:end]) * (ay - py))
+        keep.append(start + int(np.argmax(area)))
+    keep.append(n - 1)
+    return np.array(keep)
+
+def pnl_series(tradesessionid, since=None, points=2000):
+    # time and portfolio value of a session in time order, downsampled to about points rows
+    # since only returns the snapshots after that time
+    query = {'tradesession': session_key(tradesessionid)}
+    if since is not None:
+        query['timestamp'] = {'$gt': pd.Timestamp(since).to_pydatetime()}
+    cursor = portfolio_snapshots().find(query, {'_id': 0, 'timestamp': 1, 'porftoliovalue': 1}).sort('timestamp', pymongo.ASCENDING)
+    df = pd.DataFrame(list(cursor), columns=['timestamp', 'porftoliovalue']).rename(columns={'timestamp': 'time'})
+    df['time'] = pd.to_datetime(df['time'])
+    df = df.dropna()
+    if df.shape[0] > points:
+        x = df['time'].to_numpy(dtype='datetime64[ns]').view('int64').astype('float64')
+        df = df.iloc[lttb(x, df['porftoliovalue'].to_numpy(dtype='float64'), points)]
+    return df
+
+class LeaderboardCache:
+    """Leaderboard rows held in memory and keyed by backtest_id.
+
+    The collection is read once, then /tradesession patches the rows it
+    upserts. Upserts served by other workers arrive through a change
+    stream, or when the change stream is not available by reloading rows
+    older than maxage seconds.
+    """
+
+    def __init__(self, collection, maxage=60):
+        self.collection = collection
+        self.maxage = maxage
+        self.lock = threading.Lock()
+        self.rows = None
+        self.loaded = 0
+        self.version = 0
+        self.sorted = dict() # sort key -> (version, rows)
+        self.watching = False
+        self.watcher = None
+
+    def _load(self):
+        rows = dict()
+        for doc in self.collection.find({}, {'_id': 0}):
+            rows[doc.get('backtest_id')] = doc
+        with self.lock:
+            self.rows = rows
+            self.loaded = time.monotonic()
+            self.version += 1
+
+    def _ensure(self):
+        if self.rows is None or (not self.watching and time.monotonic() - self.loaded > self.maxage):
+            self._load()
+            if self.watcher is None:
+                # started once, a failed change stream leaves reloading on
+                self.watching = True
+                self.watcher = threading.Thread(target=self._watch, name='leaderboard-watch', daemon=True)
+                self.watcher.start()
+
+    def _watch(self):
+        try:
+            with self.collection.watch(full_document='updateLookup') as stream:
+                for change in stream:
+                    doc = change.get('fullDocument')
+                    if doc is not None:
+                        doc.pop('_id', None)
+                        self.patch(doc)
+        except PyMongoError as e:
+            logging.warning('Leaderboard change stream unavailable, reloading every %ss: %s', self.maxage, e)
+        self.watching = False
+
+    def patch(self, doc):
+        """Insert or replace the row of doc['backtest_id']."""
+        with self.lock:
+            if self.rows is not None:
+                self.rows[doc.get('backtest_id')] = dict(doc)
+                self.version += 1
+
+    def columns(self):
+        self._ensure()
+        names = []
+        for row in list(self.rows.values()):
+            names.extend(k for k in row if k not in names)
+        return names
+
+    def page(self, page_current=0, page_size=20, sort_by=None):
+        """Rows of one page sorted by a DataTable sort_by, and the page count."""
+        self._ensure()
+        key = tuple((s['column_id'], s['direction']) for s in (sort_by or []))
+        version, rows = self.sorted.get(key, (None, None))
+        if version != self.version:
+            with self.lock:
+                version, rows = self.version, list(self.rows.values())
+            # stable sorts from the last key to the first give a multi column sort
+            for column, direction in reversed(key):
+                present = [r for r in rows if r.get(column) is not None]
+                missing = [r for r in rows if r.get(column) is None]
+                try:
+                    present.sort(key=lambda r: r[column], reverse=direction == 'desc')
+                except TypeError:
+                    present.sort(key=lambda r: str(r[column]), reverse=direction == 'desc')
+                rows = present + missing
+            self.sorted[key] = (version, rows)
+        page_count = max(-(-len(rows) // page_size), 1)
+        return rows[page_current * page_size:(page_current + 1) * page_size], page_count
+
+leaderboardcache = LeaderboardCache(db['Leaderboard'], maxage=int(os.environ.get('algosocleaderboardage', 60)))
 
 @server.route('/')
 def main_page():
@@ -69,23 +258,18 @@ def main_page():
 
 @server.route("/user", methods=['POST'])
 def user_record():
-    password = os.environ.get('algosocdbpw', 'algosocadmin')
-    client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-    db = client['Pedlar_dev']
     req_data = request.get_json()
     user = req_data.get('user', 'sample')
     agent = req_data.get('agent', 'sample')
     # compute tradesession id 
-    tradesessionid = db['Counter'].find_one({})['counter'] + 1 
-    db['Counter'].update_one({},{"$set":{'counter':tradesessionid}})
+    tradesessionid = sessioncounter.allocate()
+    sessions_catalog().update_one({'backtest_id':tradesessionid},
+        {"$set":{'user_id':user, 'agent':agent, 'start':datetime.datetime.utcnow()}}, upsert=True)
     return jsonify(username=user, tradesession=tradesessionid)
 
 # update leaderboard after backtest 
 @server.route("/tradesession", methods=['POST'])
 def tradesession():
-    password = os.environ.get('algosocdbpw', 'algosocadmin')
-    client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-    db = client['Pedlar_dev']
     req_data = request.get_json()
     user = req_data.get('user_id', 0)
     agent = req_data.get('agent', 'sample')
@@ -94,23 +278,30 @@ def tradesession():
     sharpe = req_data.get('sharpe', -100)
     # Add to leaderboard table 
     leaderboard = db['Leaderboard']
-    leaderboard.update_one( {'backtest_id':tradesessionid} , {"$set":{'user_id':user, 'agent':agent, 'backtest_id':tradesessionid, 'pnl':pnl, 'sharpe':sharpe}}, upsert=True)
+    row = {'user_id':user, 'agent':agent, 'backtest_id':tradesessionid, 'pnl':pnl, 'sharpe':sharpe}
+    leaderboard.update_one( {'backtest_id':tradesessionid} , {"$set":row}, upsert=True)
+    leaderboardcache.patch(row)
+    sessions_catalog().update_one({'backtest_id':tradesessionid},
+        {"$set":{'user_id':user, 'agent':agent, 'pnl':pnl, 'sharpe':sharpe, 'lastupdate':datetime.datetime.utcnow()}}, upsert=True)
     return jsonify(username=user, tradesession=tradesessionid)
 
 @server.route("/portfolio/<backtestid>", methods=['POST'])
 def portfolio(backtestid):
-    password = os.environ.get('algosocdbpw', 'algosocadmin')
-    client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-    db = client['Pedlar_dev']
     req_data = request.get_json()
     tradesessionid = str(req_data.get('tradesession', 0))
-    # create capped collection 
-    if not str(tradesessionid) in db.list_collection_names():
-        db.create_collection(str(tradesessionid), capped=True, size=5000000, max=100)
-    portfolio = db[tradesessionid]
-    portfolio.insert_one(req_data)
+    portfolio_snapshots().insert_one(portfolio_documents([req_data], tradesessionid)[0])
     return jsonify(tradesession=tradesessionid)
 
+@server.route("/portfolio/<backtestid>/bulk", methods=['POST'])
+def portfolio_bulk(backtestid):
+    # list of portfolio snapshots of one trade session
+    req_data = request.get_json(silent=True)
+    if not isinstance(req_data, list):
+        return jsonify(error='expected a json list of portfolio snapshots'), 400
+    if req_data:
+        portfolio_snapshots().insert_many(portfolio_documents(req_data, backtestid), ordered=False)
+    return jsonify(tradesession=str(backtestid), inserted=len(req_data))
+
 
 
 
@@ -141,6 +332,12 @@ dash_app1.layout = html.Div(children=[
     dash_table.DataTable(
     id='leaderboard',
     columns=[],
+    page_current=0,
+    page_size=20,
+    page_action='custom',
+    sort_action='custom',
+    sort_mode='multi',
+    sort_by=[],
     style_table={
         'height': '300px',
         'overflowY': 'scroll',
@@ -152,30 +349,25 @@ dash_app1.layout = html.Div(children=[
 
 
 
-@dash_app1.callback(Output('leaderboard', 'columns'),
-              [Input('submit-val', 'n_clicks')])
-def update_leaderboard(n):
-    password = os.environ.get('algosocdbpw', 'algosocadmin')
-    client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-    data = mongo2df(client,'Pedlar_dev','Leaderboard')
-    names = data.columns 
-    return [{"name": i, "id": i} for i in names]
-  
-
-@dash_app1.callback(Output('leaderboard', 'data'),
-              [Input('submit-val', 'n_clicks')])
-def update_leaderboard_data(n):
+@dash_app1.callback([Output('leaderboard', 'columns'), Output('leaderboard', 'data'), Output('leaderboard', 'page_count')],
+              [Input('submit-val', 'n_clicks'), Input('leaderboard', 'page_current'),
+               Input('leaderboard', 'page_size'), Input('leaderboard', 'sort_by')])
+def update_leaderboard(n, page_current, page_size, sort_by):
     try:
-        password = os.environ.get('algosocdbpw', 'algosocadmin')
-        client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-        data = mongo2df(client,'Pedlar_dev','Leaderboard')
-        return data.to_dict('records')
+        names = leaderboardcache.columns()
+        data, page_count = leaderboardcache.page(page_current or 0, page_size or 20, sort_by)
+        return [{"name": i, "id": i} for i in names], data, page_count
     except:
-        return []
+        return [], [], 1
 
 
 dash_app4.layout = html.Div(children=[
     html.Span('Portfolio Value'),
+    dcc.Input(id='session-agent', type='text', placeholder='agent', debounce=True),
+    dcc.Input(id='session-user', type='text', placeholder='user', debounce=True),
+    html.Button('Older sessions', id='sessions-older', n_clicks=0),
+    # last backtest_id listed in the dropdown
+    dcc.Store(id='sessions-cursor', data={}),
     dcc.Dropdown(
     id='backtest-ids',
     options=[],
@@ -198,41 +390,54 @@ dash_app4.layout = html.Div(children=[
     ),
     style={'height': 500},
     ),
+    # session plotted and the time of its last snapshot
+    dcc.Store(id='pnl-state', data={}),
     html.Button('Refresh', id='submit-val', n_clicks=0),
 ])
 
 
 
-@dash_app4.callback(Output('backtest-ids', 'options'),
-              [Input('submit-val', 'n_clicks')])
-def update_backtest_ids(n):
+@dash_app4.callback([Output('backtest-ids', 'options'), Output('sessions-cursor', 'data')],
+              [Input('submit-val', 'n_clicks'), Input('sessions-older', 'n_clicks'),
+               Input('session-agent', 'value'), Input('session-user', 'value')],
+              [State('sessions-cursor', 'data')])
+def update_backtest_ids(n, older, agent, user, cursor):
     try:
-        password = os.environ.get('algosocdbpw', 'algosocadmin')
-        client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-        db = client['Pedlar_dev']
-        system_collections = ['Counter','Leaderboard']
-        all_collections = db.list_collection_names()
-        backtest_collections = list(set(all_collections)-set(system_collections))
-        df = pd.DataFrame()
-        df['label'] = backtest_collections
-        df['value'] = backtest_collections
-        return df.to_dict('records')
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        older = 'sessions-older.n_clicks' in triggered
+        before = (cursor or {}).get('last') if older else None
+        page = list_sessions(agent, user, before)
+        if not page:
+            # past the oldest session keep the last page, a filter matching nothing shows nothing
+            if older:
+                return dash.no_update, dash.no_update
+            return [], {}
+        options = [{'label':'{} {} {} pnl {}'.format(d['backtest_id'], d.get('agent',''), d.get('user_id',''), d.get('pnl','')),
+                    'value':str(d['backtest_id'])} for d in page]
+        return options, dict(last=page[-1]['backtest_id'])
     except:
-        return [{'label':'1','value':'1'}]
+        return [{'label':'1','value':'1'}], {}
 
 
-@dash_app4.callback(Output('pnl-graph', 'figure'),
-              [Input('submit-val', 'n_clicks'),Input('backtest-ids', 'value')])
-def update_backtest_data(n,backtestid):
+@dash_app4.callback([Output('pnl-graph', 'figure'), Output('pnl-graph', 'extendData'), Output('pnl-state', 'data')],
+              [Input('submit-val', 'n_clicks'),Input('backtest-ids', 'value')],
+              [State('pnl-state', 'data')])
+def update_backtest_data(n,backtestid,state):
     try:
-        password = os.environ.get('algosocdbpw', 'algosocadmin')
-        client = pymongo.MongoClient("mongodb+srv://algosocadmin:{}@icalgosoc-9xvha.mongodb.net/test?retryWrites=true&w=majority".format(password))
-        selected = ['porftoliovalue']
-        dff = mongo2df(client,'Pedlar_dev',backtestid)
-        trace = []
-        for type in selected:
-            trace.append(go.Scatter(x=dff['time'], y=dff[type], name=backtestid, mode='lines',
-                                marker={'size': 8, "opacity": 0.6, "line": {'width': 0.5}}, ))
+        state = state or {}
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        if state.get('backtestid') == backtestid and 'backtest-ids.value' not in triggered:
+            # same session refreshed, only append the snapshots after the last one plotted
+            dff = pnl_series(backtestid, since=state.get('last'))
+            if dff.shape[0] == 0:
+                return dash.no_update, dash.no_update, dash.no_update
+            extend = [dict(x=[dff['time'].tolist()],
+                           y=[dff['porftoliovalue'].tolist()]), [0]]
+            return dash.no_update, extend, dict(backtestid=backtestid, last=dff['time'].iloc[-1].isoformat())
+        dff = pnl_series(backtestid)
+        trace = [go.Scatter(x=dff['time'], y=dff['porftoliovalue'],
+                            name=backtestid, mode='lines',
+                            marker={'size': 8, "opacity": 0.6, "line": {'width': 0.5}}, )]
         # layout of line graph 
         _layout=dict(
             title='Portfolio value',
@@ -243,9 +448,10 @@ def update_backtest_data(n,backtestid):
             ),
             margin=dict(l=150, r=50, t=50, b=150)
         )
-        return dict(data=trace, layout=_layout)
+        last = dff['time'].iloc[-1].isoformat() if dff.shape[0] else None
+        return dict(data=trace, layout=_layout), dash.no_update, dict(backtestid=backtestid, last=last)
     except:
-        return []
+        return [], dash.no_update, {}
 
 # Linking diffrent application
 